@@ -27,21 +27,48 @@ Authors:
     Kacper Lasocha <kacper.lasocha@cern.ch>
 '''
 
+import bisect
 import configparser
-import glob
+import fnmatch
 import h5py
+import hashlib
+import json
 import logging
 import numpy as np
 import platform
 import os
 import socket
+import threading
+import time
 
+from collections import OrderedDict
 from functools import wraps
 from scipy import stats
-from scipy.interpolate import interp1d
 
 __version__ = '2017-08-09'
 
+# Version of the file summaries, summaries of other versions are ignored
+SUMMARY_VERSION = 1
+
+
+def _digest(*items):
+    '''Returns a digest of items, used as key of the summarised results
+
+    Arrays, numpy scalars and ranges are reduced to plain values, so that the
+    digest does not depend on the type they were stored with.
+    '''
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = (item.dtype.str, item.shape, item.tobytes())
+        elif isinstance(item, np.generic):
+            item = item.item()
+        elif isinstance(item, range):
+            item = ('range', item.start, item.stop, item.step)
+        h.update(repr(item).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
 
 class BQHT(object):
     def __init__(self, cfg_file=None, system=None, user=None, archive=False):
@@ -75,28 +102,57 @@ class BQHT(object):
         self.archive = archive
 
         self._user = 'ALL'
+        self._file_indexes = {}
+        self.memmap = False
+        self.summary = False
+        self.cache_size = 0
         self.system = self.systems[0] if system is None else system
 
         if user is not None:
             self.user = user
 
+    def __getstate__(self):
+        # The file indexes are not sent to other processes, they are rebuilt
+        # when needed
+        state = self.__dict__.copy()
+        state['_file_indexes'] = {}
+        return state
+
     def __repr__(self):
         return '<BQHT: system={0}>'.format(self.system, self.user)
 
-    def open_file(self, path):
+    def open_file(self, path, memmap=None, summary=None, cache_size=None):
         '''Open a HDF5 file
 
         Args:
-            path:   HDF5 file to open
+            path:       HDF5 file to open
+            memmap:     memory map contiguous datasets (defaults to
+                        self.memmap)
+            summary:    load the summary of the file if it is up to date, and
+                        save it when the file is closed (defaults to
+                        self.summary), see BQHTFile.load_summary
+            cache_size: memory budget in bytes of the block cache of each
+                        dataset, 0 to disable it (defaults to
+                        self.cache_size), see BQHTDataset.cache
 
         Returns:
             A BQHTFile instance for the file
         '''
-        htf = BQHTFile(path)
+        htf = BQHTFile(path, memmap=self.memmap if memmap is None else memmap)
 
         for attr in ('offset', 'max_offset', 'harmonic', 'frev'):
             setattr(htf, attr, getattr(self, attr))
 
+        for p, s in htf.planes_signals:
+            if htf.data[p][s] is not None:
+                htf.data[p][s].cache_size = self.cache_size if cache_size is None else cache_size
+
+        # The summary is loaded once the settings are known, as its results
+        # are only used for the same settings
+        if self.summary if summary is None else summary:
+            htf.summary = True
+            htf.load_summary()
+
         if self.invert_sigma:
             for p in htf.planes:
                 dataset = htf.data[p]['sigma']
@@ -107,7 +163,15 @@ class BQHT(object):
 
     def file(self, name):
         '''Get a file path by (partial) name'''
-        files = list(filter(lambda x: name in x, self.files))
+        index = self.file_index
+
+        # Full file names are looked up by their time stamp
+        if name.endswith('.h5') and os.path.basename(name) == name:
+            path = index.find(name)
+            if path is not None:
+                return path
+
+        files = list(filter(lambda x: name in x, index.files))
         if files:
             return files[0]
         else:
@@ -158,23 +222,139 @@ class BQHT(object):
         else:
             raise ValueError('{0} is not a valid user'.format(val))
 
+    @property
+    def filename_pattern(self):
+        '''Glob pattern of the file names for the system and user'''
+        user = '' if self.user == 'ALL' else '_{0}'.format(self.user)
+        return '{0}{1}_*.h5'.format(self.device, user)
+
+    @property
+    def file_index(self):
+        '''Index of the files for the data directory, system and user'''
+        key = (self.dir, self.filename_pattern)
+        if key not in self._file_indexes:
+            self._file_indexes[key] = BQHTFileIndex(*key)
+
+        index = self._file_indexes[key]
+        index.update()
+        return index
+
     @property
     def files(self):
-        if not os.path.isdir(self.dir):
+        return list(self.file_index.files)
+
+    def prev_file(self, path):
+        '''Returns the file before path, or None if there is none'''
+        return self.file_index.prev(path)
+
+    def next_file(self, path):
+        '''Returns the file after path, or None if there is none'''
+        return self.file_index.next(path)
+
+    def latest_file(self):
+        '''Returns the latest file, or None if there are no files'''
+        return self.file_index.latest()
+
+
+class BQHTFileIndex(object):
+    # Directories modified less than this many seconds before they were
+    # listed are listed again, as files created in the same second do not
+    # necessarily change the modification time (e.g. on NFS)
+    mtime_margin = 2.0
+
+    def __init__(self, path, pattern):
+        '''Sorted index of the files in the day directories of path
+
+        Only the day directories whose modification time changed are listed
+        again on update, the index is only re-sorted if files were added or
+        removed.
+
+        Args:
+            path:       data directory, with one sub-directory per day
+            pattern:    glob pattern of the file names
+        '''
+        self.path = path
+        self.pattern = pattern
+        self.files = []
+        self._keys = []
+        self._dirs = {}
+
+    @staticmethod
+    def _key(path):
+        # This assumes the filename has the format "SYSTEM_YYYYMMDD_HHMMSS.h5"
+        # so that the slice [-18:-3] selects just the YYYYMMDD_HHMMSS part.
+        return (path[-18:-3], path)
+
+    def _list_dir(self, path):
+        try:
+            with os.scandir(path) as it:
+                return [entry.path for entry in it if fnmatch.fnmatchcase(entry.name, self.pattern)]
+        except OSError:
             return []
-        else:
-            # Format the filename
-            user = '' if self.user == 'ALL' else '_{0}'.format(self.user)
-            filename = '{0}{1}_*.h5'.format(self.device, user)
 
-            # Glob a list of the files
-            files = glob.glob(os.path.join(self.dir, '*', filename))
+    def update(self):
+        '''Update the index from the modified day directories
+
+        Returns:
+            True if the index changed
+        '''
+        try:
+            with os.scandir(self.path) as it:
+                entries = [entry for entry in it if not entry.name.startswith('.') and entry.is_dir()]
+        except OSError:
+            entries = []
+
+        now = time.time()
+        dirs = {}
+        changed = False
+
+        for entry in entries:
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+
+            cached = self._dirs.get(entry.path)
+            if cached is not None and cached[0] == mtime and cached[1] - mtime > self.mtime_margin:
+                dirs[entry.path] = cached
+                continue
 
-            # Return a sorted list of the files. This assumes the filename has
-            # the format "SYSTEM_YYYYMMDD_HHMMSS.h5" so that the slice [-18:-3]
-            # selects just the YYYYMMDD_HHMMSS part. This is ugly but is
-            # significantly faster than doing it in a cleaner way.
-            return sorted(files, key=lambda x: x[-18:-3])
+            files = self._list_dir(entry.path)
+            dirs[entry.path] = (mtime, now, files)
+            if cached is None or cached[2] != files:
+                changed = True
+
+        if changed or dirs.keys() != self._dirs.keys():
+            self._keys = sorted(self._key(f) for _, _, files in dirs.values() for f in files)
+            self.files = [f for _, f in self._keys]
+            changed = True
+
+        self._dirs = dirs
+        return changed
+
+    def find(self, name):
+        '''Returns the path of the file with the given name, or None'''
+        stamp = name[-18:-3]
+        i = bisect.bisect_left(self._keys, (stamp,))
+        while i < len(self._keys) and self._keys[i][0] == stamp:
+            if os.path.basename(self._keys[i][1]) == name:
+                return self._keys[i][1]
+            i += 1
+        return None
+
+    def prev(self, path):
+        '''Returns the file before path, or None if there is none'''
+        i = bisect.bisect_left(self._keys, self._key(path))
+        return self.files[i - 1] if i > 0 else None
+
+    def next(self, path):
+        '''Returns the file after path, or None if there is none'''
+        i = bisect.bisect_right(self._keys, self._key(path))
+        return self.files[i] if i < len(self.files) else None
+
+    def latest(self):
+        '''Returns the latest file, or None if there are no files'''
+        return self.files[-1] if self.files else None
 
 
 class BQHTGroup(object):
@@ -205,11 +385,17 @@ class BQHTGroup(object):
 
 
 class BQHTFile(object):
-    def __init__(self, path):
+    def __init__(self, path, memmap=False):
         '''A Head-Tail file
 
+        The results of locate_bunches and optimise_overlap are remembered for
+        the settings they were obtained with, and can be kept in a summary
+        next to the file together with the baseline means of the datasets,
+        see load_summary and save_summary.
+
         Args:
             path:   path of HDF5 file
+            memmap: memory map contiguous datasets, see BQHTDataset
         '''
         self._log = logging.getLogger(__name__)
 
@@ -235,6 +421,12 @@ class BQHTFile(object):
         self.turn_adjust = None
         self.align = False
 
+        # Remembered results, by digest of their settings
+        self.summary = False
+        self.summary_size = 16
+        self._summary = {'locate': OrderedDict(), 'overlap': OrderedDict(), 'means': {}}
+        self._summary_saved = None
+
         # Create dataset for each plane/signal
         for i, (p, s) in enumerate(self.planes_signals):
             for k, v in [(s, s)] + list(aliases.items()):
@@ -247,7 +439,7 @@ class BQHTFile(object):
                 self.data[p][s] = None
                 continue
 
-            self.data[p][s] = BQHTDataset(dataset)
+            self.data[p][s] = BQHTDataset(dataset, memmap=memmap)
             self.data[p][s].remove_baseline = True if s == 'delta' else False
             self.data[p][s].plane = p
             self.data[p][s].signal = s
@@ -273,8 +465,10 @@ class BQHTFile(object):
         self.close()
 
     def close(self):
-        '''Close the file'''
+        '''Close the file, saving its summary if enabled'''
         if not self.closed:
+            if self.summary:
+                self.save_summary()
             self.h5file.close()
             self.data = {p: {s: None for s in self.signals} for p in self.planes}
             self.closed = True
@@ -305,8 +499,166 @@ class BQHTFile(object):
                 setattr(self.data[p][s], name, value)
         setattr(self, '_' + name, value)
 
+    @staticmethod
+    def summary_path(path):
+        '''Returns the path of the summary of a file
+
+        The summary is a hidden file next to the file, which does not match
+        the file name patterns.
+        '''
+        head, tail = os.path.split(path)
+        return os.path.join(head, '.{0}.summary.npz'.format(tail))
+
+    @staticmethod
+    def remove_summary(path):
+        '''Remove the summary of a file, if there is one'''
+        try:
+            os.remove(BQHTFile.summary_path(path))
+        except OSError:
+            pass
+
+    def _source_stamp(self):
+        '''Returns the size and modification time the summary is valid for'''
+        st = os.stat(self.filename)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _remember(self, kind, key, value):
+        '''Remember a result, keeping the last summary_size results'''
+        results = self._summary[kind]
+        results[key] = value
+        results.move_to_end(key)
+        while len(results) > self.summary_size:
+            results.popitem(last=False)
+
+    def _summary_means(self):
+        '''Returns the baseline means to summarise
+
+        These are the current mean of each dataset, or the mean loaded from
+        the summary if it has not been replaced.
+
+        Returns:
+            A list of (plane, signal, key, mean) tuples
+        '''
+        means = []
+        for p, s in self.planes_signals:
+            dataset = self.data[p][s]
+            if dataset is None:
+                continue
+
+            key = dataset._mean_key() if dataset.mean is not None else None
+            if key is None or dataset._mean_cache.get(key) is not dataset.mean:
+                key = self._summary['means'].get((p, s))
+
+            if key in dataset._mean_cache:
+                means.append((p, s, key, dataset._mean_cache[key]))
+        return means
+
+    def _summary_keys(self):
+        '''Returns the keys of the results to summarise'''
+        return (list(self._summary['locate']), list(self._summary['overlap']),
+                [(p, s, key) for p, s, key, _ in self._summary_means()])
+
+    @_check_closed
+    def load_summary(self):
+        '''Load the summary of the file, if it is up to date
+
+        The summary holds the results of locate_bunches and optimise_overlap
+        and the baseline means of the datasets, by digest of the settings
+        they were obtained with. Calls with the same settings then use these
+        results instead of processing the data again. The summary is ignored
+        if the file changed since it was saved.
+
+        Returns:
+            True if the summary was loaded
+        '''
+        path = self.summary_path(self.filename)
+
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                info = json.loads(str(npz['info']))
+                if info.get('version') != SUMMARY_VERSION or info.get('source') != self._source_stamp():
+                    return False
+                arrays = {k: npz[k] for k in npz.files if k != 'info'}
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            self._log.warning('Could not load summary {0} [{1}]'.format(path, e))
+            return False
+
+        for key, bunches, turns in info['locate']:
+            self._summary['locate'][key] = (bunches, range(*turns) if turns else [])
+
+        for key, frev, name in info['overlap']:
+            self._summary['overlap'][key] = (frev, None if name is None else arrays[name])
+
+        for p, s, key, name in info['means']:
+            dataset = self.data[p][s]
+            if dataset is not None:
+                dataset._mean_cache[key] = arrays[name]
+                self._summary['means'][(p, s)] = key
+
+        self._summary_saved = self._summary_keys()
+        return True
+
+    @_check_closed
+    def save_summary(self):
+        '''Save the summary of the file, see load_summary
+
+        The summary is written next to the file, nothing is written if it did
+        not change since it was loaded or saved, or if the directory is not
+        writeable.
+
+        Returns:
+            True if the summary was saved
+        '''
+        keys = self._summary_keys()
+        if keys == self._summary_saved or not any(keys):
+            return False
+
+        path = self.summary_path(self.filename)
+        if not os.access(os.path.dirname(path) or os.curdir, os.W_OK):
+            return False
+
+        info = {'version': SUMMARY_VERSION, 'locate': [], 'overlap': [], 'means': []}
+        arrays = {}
+
+        for key, (bunches, turns) in self._summary['locate'].items():
+            info['locate'].append([key, [int(b) for b in bunches], [turns.start, turns.stop] if turns else None])
+
+        for key, (frev, turn_adjust) in self._summary['overlap'].items():
+            name = None
+            if turn_adjust is not None:
+                name = 'turn_adjust_{0}'.format(len(arrays))
+                arrays[name] = np.asarray(turn_adjust)
+            info['overlap'].append([key, float(frev), name])
+
+        for p, s, key, mean in self._summary_means():
+            name = 'mean_{0}'.format(len(arrays))
+            arrays[name] = mean
+            info['means'].append([p, s, key, name])
+
+        # Write to a temporary file first, so that other processes never
+        # see a partial summary, the name is unique to the thread as the
+        # viewer saves summaries from several threads
+        tmp = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            info['source'] = self._source_stamp()
+            with open(tmp, 'wb') as f:
+                np.savez(f, info=np.array(json.dumps(info)), **arrays)
+            os.replace(tmp, path)
+        except OSError as e:
+            self._log.warning('Could not save summary {0} [{1}]'.format(path, e))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+
+        self._summary_saved = keys
+        return True
+
     @_check_closed
-    def locate_bunches(self, plane='horizontal', signal='sigma', threshold=5, parts=5):
+    def locate_bunches(self, plane='horizontal', signal='sigma', threshold=5, parts=5, block_turns=32, margin=4):
         '''Locate bunches in data
 
         Splits each bunch into nb_parts and calculates the amplitude of each
@@ -315,24 +667,36 @@ class BQHTFile(object):
         to be present.
 
         Args:
-            plane:      plane to use for detection
-            signal:     signal to use for detection
-            threshold:  threshold for detection
-            parts:      number of parts for each bunch
+            plane:          plane to use for detection
+            signal:         signal to use for detection
+            threshold:      threshold for detection
+            parts:          number of parts for each bunch
+            block_turns:    number of turns checked at once when following
+                            the first bunch
+            margin:         extra slots checked on each side of the first
+                            bunch, to follow the slippage within a block
         '''
         dataset = self.data[plane][signal]
 
+        key = _digest('locate', plane, signal, threshold, parts, dataset._state_key())
+        if key in self._summary['locate']:
+            bunches, self.populated_turns = self._summary['locate'][key]
+            self.bunches = list(bunches)
+            return
+
         max_turn = dataset.number_of_turns - 1
         max_bunch = dataset.number_of_bunches - 1
 
         # Check for bunches in first turn
-        self.bunches = self._locate_bunches(0, 0, max_bunch, dataset, threshold, parts)
+        occupancy = self._bunch_occupancy(dataset, [0], 0, max_bunch, threshold, parts)
+        self.bunches = np.flatnonzero(occupancy[0]).tolist()
         turn_range = range(0, dataset.number_of_turns)
         reverse = False
 
         # If no bunches in first turn, check last turn
         if not self.bunches:
-            self.bunches = self._locate_bunches(max_turn, 0, max_bunch, dataset, threshold, parts)
+            occupancy = self._bunch_occupancy(dataset, [max_turn], 0, max_bunch, threshold, parts)
+            self.bunches = np.flatnonzero(occupancy[0]).tolist()
             turn_range = reversed(turn_range)
             reverse = True
 
@@ -341,47 +705,42 @@ class BQHTFile(object):
             bunch = self.bunches[0]
             populated_turns = []
 
-            for turn in turn_range:
-                # Compare also slots on each side of the bunch to account for
-                # slippage due to incorrect frev value (search +10 slots as frev
-                # is quite far off for ions)
-                first_bunch = bunch - 1
-                last_bunch = bunch + 10
-
-                # Handle case where we have full turns, in this case if we reach
-                # the first or last bunch, wrap around at the harmonic
-                if dataset.number_of_bunches == dataset.harmonic:
-                    if first_bunch < 0:
-                        first_bunch = dataset.harmonic + first_bunch
-                        bunches = []
-                        if turn > 0:
-                            bunches.extend(self._locate_bunches(turn - 1, first_bunch, dataset.harmonic - 1,
-                                                                dataset, threshold, parts))
-                        bunches.extend(self._locate_bunches(turn, 0, last_bunch, dataset, threshold, parts))
-                    elif last_bunch >= dataset.harmonic:
-                        last_bunch = last_bunch - dataset.harmonic
-                        bunches = self._locate_bunches(turn, first_bunch, dataset.harmonic - 1,
-                                                       dataset, threshold, parts)
-                        if turn < dataset.number_of_turns - 1:
-                            bunches.extend(self._locate_bunches(turn + 1, 0, last_bunch, dataset, threshold, parts))
-                    else:
-                        bunches = self._locate_bunches(turn, first_bunch, last_bunch, dataset, threshold, parts)
-
-                # Handle the case where we do not have full turns, in this case
-                # limit to the min/max.
-                else:
-                    if first_bunch < 0:
-                        first_bunch = 0
-                    elif last_bunch >= dataset.number_of_bunches:
-                        last_bunch = dataset.number_of_bunches - 1
-
-                    bunches = self._locate_bunches(turn, first_bunch, last_bunch, dataset, threshold, parts)
+            # Handle case where we have full turns, in this case if we reach
+            # the first or last bunch, wrap around at the harmonic. Otherwise
+            # limit to the min/max.
+            full_turns = dataset.number_of_bunches == dataset.harmonic
+
+            def bunch_range(first_bunch, last_bunch):
+                if full_turns:
+                    return (first_bunch, last_bunch)
+                return (max(first_bunch, 0), min(last_bunch, max_bunch))
+
+            turn_range = list(turn_range)
+            i = 0
+            while i < len(turn_range):
+                # Occupancy of the slots around the bunch for a block of turns
+                block = turn_range[i:i + block_turns]
+                band_first, band_last = bunch_range(bunch - 1 - margin, bunch + 10 + margin)
+                occupancy = self._bunch_occupancy(dataset, block, band_first, band_last, threshold, parts)
+
+                for turn, turn_occupancy in zip(block, occupancy):
+                    # Compare also slots on each side of the bunch to account
+                    # for slippage due to incorrect frev value (search +10
+                    # slots as frev is quite far off for ions)
+                    first_bunch, last_bunch = bunch_range(bunch - 1, bunch + 10)
+
+                    # The bunch slipped out of the checked slots, start a new
+                    # block from this turn
+                    if first_bunch < band_first or last_bunch > band_last:
+                        break
 
-                # We found bunches in this turn, for the next turn use the first
-                # found bunch to follow the slippage
-                if bunches:
-                    populated_turns.append(turn)
-                    bunch = bunches[0]
+                    # We found bunches in this turn, for the next turn use the
+                    # first found bunch to follow the slippage
+                    bunches = turn_occupancy[(first_bunch - band_first):(last_bunch - band_first + 1)]
+                    if bunches.any():
+                        populated_turns.append(turn)
+                        bunch = int(first_bunch + np.argmax(bunches)) % dataset.number_of_bunches
+                    i += 1
 
             # Correct the bunch numbers for the slippage
             if reverse:
@@ -393,43 +752,74 @@ class BQHTFile(object):
         else:
             self.populated_turns = []
 
+        self._remember('locate', key, (list(self.bunches), self.populated_turns))
+
     @_check_closed
-    def _locate_bunches(self, turn, first_bunch, last_bunch, dataset, threshold, parts):
-        '''Locate bunches for a specific turn within a specific bunch range'''
-        bunches = []
-
-        # Extract data for whole range as this is faster than extracting it
-        # bunch by bunch. We need to get the data without padding, otherwise
-        # some parts may contain all/mostly zeros which breaks the amplitude
-        # calculation.
-        _, turn_data = dataset.get(turn, first_bunch, last_bunch, baseline=False, pad=False, align=False)
-
-        for bunch in range(0, last_bunch - first_bunch + 1):
-            # Slice bunch data
-            bunch_start = int(bunch * dataset.samples_per_bunch)
-            bunch_end = int(bunch_start + dataset.samples_per_bunch)
-            bunch_data = turn_data[bunch_start:bunch_end]
-            bunch_len = int(bunch_data.size - (bunch_data.size % parts))
-
-            # Reshape into parts
-            part_data = bunch_data[0:bunch_len].reshape(parts, bunch_len // parts)
-
-            if part_data.size == 0:
-                continue
+    def _bunch_occupancy(self, dataset, turns, first_bunch, last_bunch, threshold, parts):
+        '''Locate bunches for several turns within a specific bunch range
 
-            # Calculate amplitude of each part
-            part_amp = np.max(part_data, axis=1) - np.min(part_data, axis=1)
+        The bunch range may extend before the first or after the last bunch,
+        in which case it continues in the previous or next turn. The data for
+        all turns is read at once and reshaped into a (turns, bunches, parts,
+        samples) array to calculate the amplitude of each part with a single
+        reduction.
 
-            # Check if any part amplitude is above threshold
-            if max(part_amp) > threshold * min(part_amp):
-                bunches.append(first_bunch + bunch)
+        Returns:
+            A (turns, bunches) boolean array, True where a bunch is present
+        '''
+        turns = np.asarray(turns, dtype=int)
+        nb_bunches = dataset.number_of_bunches
+        nb_turns = dataset.number_of_turns
+        bunch_inc = dataset.samples_per_bunch
 
-        return bunches
+        # Slots in the range for each turn, they must be in the data
+        slots = turns[:, np.newaxis] * nb_bunches + np.arange(first_bunch, last_bunch + 1)
+        valid = (slots >= 0) & (slots < nb_turns * nb_bunches)
+        slot_turn, slot_bunch = np.divmod(np.clip(slots, 0, max(nb_turns * nb_bunches - 1, 0)), nb_bunches)
+
+        # We need the data without padding, otherwise some parts may contain
+        # all/mostly zeros which breaks the amplitude calculation.
+        bunch_len = int(bunch_inc) - int(bunch_inc) % parts
+        if bunch_len == 0 or not valid.any():
+            return np.zeros(slots.shape, dtype=bool)
+
+        turn_adjust = np.zeros(slot_turn.shape)
+        if dataset.remove_jitter and dataset.turn_adjust is not None:
+            has_adjust = slot_turn < len(dataset.turn_adjust)
+            turn_adjust[has_adjust] = np.asarray(dataset.turn_adjust)[slot_turn[has_adjust]]
+
+        bunch_sta = ((slot_turn * dataset.samples_per_turn + turn_adjust).astype(int) +
+                     (slot_bunch * bunch_inc).astype(int) +
+                     dataset.t_to_samples(dataset.offset) + 1 +
+                     dataset.t_to_samples(dataset.deskew) +
+                     dataset.trigger_offset)
+        valid &= (bunch_sta >= 0) & (bunch_sta + bunch_len <= dataset.size)
+
+        # Extract data for whole range of each turn as this is faster than
+        # extracting it bunch by bunch
+        row_sta = np.where(valid, bunch_sta, np.iinfo(int).max).min(axis=1)
+        row_sta[row_sta == np.iinfo(int).max] = 0
+        row_len = int(np.max(np.where(valid, bunch_sta - row_sta[:, np.newaxis], 0))) + bunch_len
+        turn_data = dataset.convert_data(dataset._read_blocks(row_sta, row_len))
+
+        # Reshape into parts
+        bunch_samp = np.where(valid, bunch_sta - row_sta[:, np.newaxis], 0)[:, :, np.newaxis] + np.arange(bunch_len)
+        part_data = turn_data[np.arange(turns.size)[:, np.newaxis, np.newaxis], bunch_samp]
+        part_data = part_data.reshape(slots.shape + (parts, bunch_len // parts))
+
+        # Calculate amplitude of each part
+        part_amp = np.max(part_data, axis=3) - np.min(part_data, axis=3)
+
+        # Check if any part amplitude is above threshold
+        return valid & (np.max(part_amp, axis=2) > threshold * np.min(part_amp, axis=2))
 
     @_check_closed
     def optimise_overlap(self, plane='horizontal', signal='sigma', **kwargs):
         '''Opitimizes overlap values for single/multi-segment cases
 
+        The result is remembered for the bunches, turns and settings, so the
+        random sample points are only drawn the first time.
+
         Args:
             plane:      plane to use for detection
             signal:     signal to use for detection
@@ -438,20 +828,30 @@ class BQHTFile(object):
 
         if len(self.bunches) == 0:
             self.turn_adjust = None
-        elif dataset.segments == 1:
-            self.frev, self.turn_adjust = self._optimise_overlap_single_segment(dataset, **kwargs)
-        elif dataset.turn_adjust is None:
-            self.frev, self.turn_adjust = self._optimise_overlap_multi_segment(dataset, **kwargs)
+        elif dataset.segments == 1 or dataset.turn_adjust is None:
+            key = _digest('overlap', plane, signal, sorted(kwargs.items()), self.bunches,
+                          dataset.populated_turns, dataset._state_key())
+            if key not in self._summary['overlap']:
+                if dataset.segments == 1:
+                    result = self._optimise_overlap_single_segment(dataset, **kwargs)
+                else:
+                    result = self._optimise_overlap_multi_segment(dataset, **kwargs)
+                self._remember('overlap', key, result)
+            self.frev, self.turn_adjust = self._summary['overlap'][key]
 
     @_check_closed
-    def _calculate_fitness(self, bunch0, bunch1_interp, distance, best_fit, points):
-        '''Calculate fitness'''
-        square_diffs = 0.0
-        for p in points:
-            square_diffs = square_diffs + (bunch0[p] - bunch1_interp(p + distance))**2
-            if square_diffs > best_fit:
-                break
-        return square_diffs
+    def _calculate_fitness_array(self, bunch0, bunch1_samp, bunch1_data, distances, points):
+        '''Calculate fitness for several distances at once
+
+        Evaluates all distances x points in a single array operation using
+        linear interpolation of the comparison bunch. Distances for which a
+        point falls outside of the comparison bunch get an infinite fitness.
+        '''
+        points = np.asarray(points)
+        x = points[np.newaxis, :] + np.asarray(distances)[:, np.newaxis]
+        bunch1_interp = np.interp(x, bunch1_samp, bunch1_data, left=np.nan, right=np.nan)
+        square_diffs = np.sum((bunch0[points] - bunch1_interp)**2, axis=1)
+        return np.where(np.isnan(square_diffs), np.inf, square_diffs)
 
     @_check_closed
     def _generate_points(self, data, rand):
@@ -470,7 +870,7 @@ class BQHTFile(object):
         return points
 
     @_check_closed
-    def _optimise_overlap_single_segment(self, dataset, rand=True, magnitude=10, iterations=5):
+    def _optimise_overlap_single_segment(self, dataset, rand=True, magnitude=10, iterations=5, tol=None):
         '''Optimise overlap for a single segment
 
         Args:
@@ -478,6 +878,8 @@ class BQHTFile(object):
             rand:           use random samples in the bunch
             magnitude:      initial magnitude
             iterations:     number of iterations
+            tol:            stop iterating once the magnitude is below tol
+                            samples (None to perform all iterations)
         '''
         self._log.info('Using single segment optimiser')
 
@@ -499,7 +901,7 @@ class BQHTFile(object):
             first_bunch_end = int(first_bunch_start + bunch_inc)
 
             first_bunch_data = np.array(
-                dataset.convert_data(dataset._dataset[first_bunch_start:first_bunch_end])
+                dataset.convert_data(dataset._read(first_bunch_start, first_bunch_end))
             )
 
             # Calculate sample points
@@ -510,9 +912,8 @@ class BQHTFile(object):
             # Perform fitting
             # Precision up to 0.001 at default
             for j in range(1, iterations + 1):
-                fitness = []
-                distance = 0
-                best_fit = float('inf')
+                if tol is not None and mag < tol:
+                    break
 
                 # Turn for comparison
                 comp_turn = int(min(10**(j - 1) + 1, nb_turns) - 1)
@@ -523,43 +924,40 @@ class BQHTFile(object):
 
                 # Extract comparison bunch data
                 comp_bunch_data = np.array(dataset.convert_data(
-                    dataset._dataset[first_bunch_start + comp_bunch_start:first_bunch_start + comp_bunch_end]
+                    dataset._read(first_bunch_start + comp_bunch_start, first_bunch_start + comp_bunch_end)
                 ))
 
                 # Samples for interpolation
                 comp_bunch_samp = np.arange(comp_bunch_start, comp_bunch_end)
-                comp_bunch_interp = interp1d(comp_bunch_samp, comp_bunch_data, assume_sorted=True,
-                                             bounds_error=False)
-
-                # Fitting
-                for i in range(-10, 11):
-                    repeat = repeat_approx + (i * mag)
-                    new_distance = comp_turn * repeat
-                    if new_distance != distance:
-                        distance = new_distance
-                        fit = self._calculate_fitness(first_bunch_data, comp_bunch_interp, distance,
-                                                      best_fit, points)
-                        fitness.append(fit)
-                        best_fit = min(fit, best_fit)
-                    else:
-                        fitness.append(fitness[-1])
-
-                best_index = fitness.index(min(fitness))
+
+                # Fitting, all repeat values are evaluated at once
+                repeats = repeat_approx + np.arange(-10, 11) * mag
+                fitness = self._calculate_fitness_array(first_bunch_data, comp_bunch_samp, comp_bunch_data,
+                                                        comp_turn * repeats, points)
+
+                best_index = int(np.argmin(fitness))
                 repeat_approx += (best_index - 10) * mag
                 mag /= 10
 
             return (repeat_approx * dataset.period, None)
 
     @_check_closed
-    def _optimise_overlap_multi_segment(self, dataset, rand=True, magnitude=1, iterations=1, limit=None):
+    def _optimise_overlap_multi_segment(self, dataset, rand=True, magnitude=1, iterations=1, limit=None,
+                                        chunk_size=1024):
         '''Optimise overlap for a multiple segments
 
+        The segments are processed in chunks, reading the comparison bunch
+        of all segments in a chunk at once and fitting all their offsets
+        together.
+
         Args:
             dataset:        dataset on which to operate
             rand:           use random samples in the bunch
             magnitude:      initial magnitude
-            iterations:     number of iterations
+            iterations:     number of iterations, iterations after the
+                            first refine the offsets to sub-sample precision
             limit:          limit to N segments (for testing)
+            chunk_size:     number of segments processed at once
         '''
         self._log.info('Using multi segment optimiser ({0} segments)'.format(dataset.segments))
 
@@ -579,54 +977,53 @@ class BQHTFile(object):
         first_bunch_end = int(first_bunch_start + bunch_inc)
 
         first_bunch_data = np.array(
-            dataset.convert_data(dataset._dataset[first_bunch_start:first_bunch_end])
+            dataset.convert_data(dataset._read(first_bunch_start, first_bunch_end))
         )
 
         offset_array = [0 for _ in range(0, dataset.populated_turns[0] + 1)]
 
         # Calculate sample points
-        points = self._generate_points(first_bunch_data, rand)
-
-        for segment in range(1, len(dataset.populated_turns)):
-            if segment < limit:
-                segment_start = int(samples_per_segment * segment)
-                distance_approx = segment_start
-                mag = magnitude
-                for j in range(1, iterations + 1):
-                    best_fit = float('inf')
-                    fitness = []
-
-                    # Bunch position for comparison
-                    comp_bunch_start = int(segment_start - 10 * mag)
-                    comp_bunch_end = int(comp_bunch_start + bunch_inc + 20 * mag + 1)
-
-                    # Extract comparison bunch data
-                    comp_bunch_data = np.array(dataset.convert_data(
-                        dataset._dataset[first_bunch_start + comp_bunch_start:first_bunch_start + comp_bunch_end]
-                    ))
-
-                    # Samples for interpolation
-                    if mag >= 1:
-                        comp_bunch_interp = lambda x: comp_bunch_data[x - segment_start + (10 * mag)]
-                    else:
-                        comp_bunch_samp = np.arange(comp_bunch_start, comp_bunch_end)
-                        comp_bunch_interp = interp1d(comp_bunch_samp, comp_bunch_data, assume_sorted=True,
-                                                     bounds_error=False)
-
-                    for i in range(-10, 11):
-                        distance = distance_approx + (i * mag)
-                        fit = self._calculate_fitness(first_bunch_data, comp_bunch_interp, distance,
-                                                      best_fit, points)
-                        fitness.append(fit)
-                        best_fit = min(fit, best_fit)
-
-                    best_index = fitness.index(min(fitness))
-                    distance_approx += (best_index - 10) * mag
-                    mag /= 10
-
-                offset_array.append(distance_approx - segment_start)
-            else:
-                offset_array.append(0)
+        points = np.array(self._generate_points(first_bunch_data, rand))
+
+        # Samples to read around the start of each segment, covering the
+        # search range of all iterations
+        reach = int(np.ceil(sum(10 * magnitude / 10**j for j in range(iterations)))) + 1
+        width = int(np.ceil(bunch_inc)) + 2 * reach + 1
+
+        segments = np.arange(1, max(min(limit, len(dataset.populated_turns)), 1))
+        segment_starts = (samples_per_segment * segments).astype(int)
+
+        for chunk in range(0, segments.size, chunk_size):
+            chunk_starts = segment_starts[chunk:chunk + chunk_size]
+
+            # Extract comparison bunch data for all segments at once
+            comp_bunch_data = np.array(dataset.convert_data(
+                dataset._read_blocks(first_bunch_start + chunk_starts - reach, width)
+            ))
+            rows = np.arange(chunk_starts.size)[:, np.newaxis, np.newaxis]
+
+            shifts = np.zeros(chunk_starts.size)
+            mag = magnitude
+            for _ in range(iterations):
+                # Window positions of the points for every segment and shift
+                distances = shifts[:, np.newaxis] + np.arange(-10, 11) * mag
+                x = points + reach + distances[:, :, np.newaxis]
+                x_lo = np.floor(x).astype(int)
+                x_cor = x - x_lo
+                valid = np.all((x_lo >= 0) & (x_lo < width - 1), axis=2)
+                x_lo = np.clip(x_lo, 0, width - 2)
+
+                # Linear interpolation, exact for integer shifts
+                comp = comp_bunch_data[rows, x_lo] * (1 - x_cor) + comp_bunch_data[rows, x_lo + 1] * x_cor
+                fitness = np.sum((first_bunch_data[points] - comp)**2, axis=2)
+                fitness[~valid] = np.inf
+
+                shifts += (np.argmin(fitness, axis=1) - 10) * mag
+                mag /= 10
+
+            offset_array.extend(shifts.tolist())
+
+        offset_array.extend([0 for _ in range(segments.size + 1, len(dataset.populated_turns))])
 
         offset_array.extend([0 for _ in range(dataset.populated_turns[-1], dataset.segments - 1)])
 
@@ -657,16 +1054,21 @@ class BQHTFile(object):
             inside_pts = np.where(sigma_data_t0_b0**2 >= 0.01 * max(sigma_data_t0_b0**2))[0]
             outside_pts = np.array(list(set(range(int(sigma_dataset.samples_per_bunch))) - set(inside_pts)))
 
-            for bunch in self.bunches:
-                mean_inside = 0
-                mean_outside = 0
+            # Delta data of all turns for blocks of bunches at once
+            turns = range(nb_turns)
+            for bunches in self._bunch_blocks(self.bunches, delta_dataset, nb_turns):
+                _, bunch_data = delta_dataset.get_bunches(turns, bunches)
+                mean_inside = np.sum(np.mean(bunch_data[..., inside_pts]**2, axis=2, dtype=np.float64), axis=0)
+                mean_outside = np.sum(np.mean(bunch_data[..., outside_pts]**2, axis=2, dtype=np.float64), axis=0)
 
-                for turn in range(nb_turns):
-                    bunch_data = delta_dataset[turn, bunch][1]
-                    mean_inside += np.mean(bunch_data[inside_pts]**2) / nb_turns
-                    mean_outside += np.mean(bunch_data[outside_pts]**2) / nb_turns
+                for bunch, m_outside, m_inside in zip(bunches, mean_outside / nb_turns, mean_inside / nb_turns):
+                    self.bunch_stability[plane][bunch] = (float(m_outside), float(m_inside))
 
-                self.bunch_stability[plane][bunch] = (mean_outside, mean_inside)
+    @_check_closed
+    def _bunch_blocks(self, bunches, dataset, nb_turns, block_samples=2**24):
+        '''Split bunches into blocks of about block_samples samples for all turns'''
+        size = max(1, int(block_samples // max(nb_turns * dataset.samples_per_bunch, 1)))
+        return [bunches[i:(i + size)] for i in range(0, len(bunches), size)]
 
     @_check_closed
     def calculate_mode(self, threshold=2.35):
@@ -691,40 +1093,194 @@ class BQHTFile(object):
 
             mode_points = np.where(sigma_data_t0_b0**2 >= 0.1 * max(sigma_data_t0_b0**2))[0]
 
-            for bunch in self.bunches:
-                if self.bunch_stability[plane][bunch][1]/self.bunch_stability[plane][bunch][0] >= threshold:
-                    mode_amplitudes = np.zeros(len(mode_points))
+            unstable = [bunch for bunch in self.bunches
+                        if self.bunch_stability[plane][bunch][1]/self.bunch_stability[plane][bunch][0] >= threshold]
+
+            turns = range(nb_turns)
+            for bunches in self._bunch_blocks(unstable, delta_dataset, nb_turns):
+                _, bunch_data = delta_dataset.get_bunches(turns, bunches)
+                mode_amplitudes = np.sum(bunch_data[..., mode_points]**2, axis=0, dtype=np.float64)
+
+                max_amplitude = np.max(mode_amplitudes, axis=1)[:, np.newaxis]
 
-                    for turn in range(nb_turns):
-                        bunch_data = delta_dataset[turn, bunch][1]
-                        for i, point in enumerate(mode_points):
-                            mode_amplitudes[i] += bunch_data[point]**2
+                # Look at all windows of 5 points at once, a local minimum
+                # is in the middle of the window
+                windows = max(len(mode_points) - 4, 0)
+                amp = [mode_amplitudes[:, i:(i + windows)] for i in range(5)]
+
+                high_mode = (amp[1] > amp[2]) & (amp[2] < amp[3])
+                low_mode = (high_mode & (amp[0] > amp[2]) & (amp[2] < amp[4]) &
+                            (max_amplitude > 2.5*amp[2]) & (mode_points[4:(4 + windows)] - mode_points[:windows] < 6))
+
+                local_mins = np.sum(low_mode, axis=1)
+                local_mins_high_mode = np.sum(high_mode, axis=1) - 1
+                local_mins = np.where(local_mins_high_mode > 5, local_mins_high_mode, local_mins)
+
+                for bunch, mins in zip(bunches, local_mins):
+                    self.instability_mode[plane][bunch] = int(mins) / 2
+
+
+class BQHTBlockCache(object):
+    def __init__(self, dataset, block_size, max_bytes, readahead=32):
+        '''Read-through LRU cache of blocks of a 1D HDF5 dataset
+
+        When reads follow each other with a constant step, e.g. the same
+        bunch turn after turn or consecutive bunches, the blocks of the next
+        reads are read ahead in the same HDF5 read. The number of reads
+        ahead doubles up to readahead blocks while the step stays constant.
+
+        Args:
+            dataset:    HDF5 dataset
+            block_size: number of samples in each block
+            max_bytes:  memory budget of the cached blocks
+            readahead:  maximum number of blocks read ahead
+        '''
+        self._dataset = dataset
+        self.size = dataset.size
+        self.block_size = int(block_size)
+        self.max_blocks = max(1, int(max_bytes // (self.block_size * dataset.dtype.itemsize)))
+        self.readahead = max(0, min(readahead, self.max_blocks // 2))
+
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sta = None
+        self._step = None
+        self._window = 1
+
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+
+    def __contains__(self, block):
+        return block in self._blocks
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def blocks(self, sta, end):
+        '''Returns the sorted blocks holding the samples sta to end of each
+        pair of sta, end arrays'''
+        first = np.asarray(sta, dtype=int) // self.block_size
+        counts = (np.asarray(end, dtype=int) - 1) // self.block_size - first + 1
+        return np.unique(np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum()))
+
+    def read(self, sta, end):
+        '''Returns the samples from sta to end (within the dataset)
+
+        The returned array may be a read-only view of a cached block.
+        '''
+        if end <= sta:
+            return np.empty(0, dtype=self._dataset.dtype)
+
+        first = sta // self.block_size
+        last = (end - 1) // self.block_size
+
+        with self._lock:
+            missing = [b for b in range(first, last + 1) if b not in self._blocks]
+            self.hits += last - first + 1 - len(missing)
+            self.misses += len(missing)
+
+            # Constant step between reads, allowing for the jitter of the
+            # turns
+            step = None if self._last_sta is None else sta - self._last_sta
+            regular = (step is not None and self._step is not None and step > 0 and
+                       abs(step - self._step) <= self.block_size // 16)
+
+            if missing:
+                ahead = []
+                if regular and self.readahead > 0:
+                    nb = self._window * max(1, self.block_size // step)
+                    k = np.arange(1, nb + 1) * step
+                    ahead = [b for b in self.blocks(sta + k, end + k).tolist()
+                             if b not in self._blocks and b * self.block_size < self.size]
+                    ahead = ahead[:(self._window * (last - first + 1))]
+                    self._window = min(2 * self._window, self.readahead)
+                else:
+                    self._window = 1
+
+                self._fetch(missing + ahead)
+
+            self._last_sta = sta
+            self._step = step
+
+            blocks = []
+            for b in range(first, last + 1):
+                self._blocks.move_to_end(b)
+                blocks.append(self._blocks[b])
+
+        offset = first * self.block_size
+        if len(blocks) == 1:
+            return blocks[0][(sta - offset):(end - offset)]
+        else:
+            return np.concatenate(blocks)[(sta - offset):(end - offset)]
+
+    def read_blocks(self, sta, end):
+        '''Read the samples sta to end of each pair of sta, end arrays
+
+        Returns:
+            A tuple (data, pos) where data holds the samples of all the
+            blocks and pos is the position of each sta in it
+        '''
+        needed = self.blocks(sta, end)
 
-                    max_amplitude = np.max(mode_amplitudes)
+        with self._lock:
+            missing = [b for b in needed.tolist() if b not in self._blocks]
+            self.hits += needed.size - len(missing)
+            self.misses += len(missing)
 
-                    local_mins = 0
-                    local_mins_high_mode = -1
-                    for i in range(len(mode_amplitudes)-4):
-                        if mode_amplitudes[i+1] > mode_amplitudes[i+2] and mode_amplitudes[i+2] < mode_amplitudes[i+3]:
-                            local_mins_high_mode += 1
-                            if mode_amplitudes[i] > mode_amplitudes[i+2] and mode_amplitudes[i+2] < mode_amplitudes[i+4]:
-                                if max_amplitude > 2.5*mode_amplitudes[i+2] and mode_points[i+4] - mode_points[i] < 6:
-                                    local_mins += 1
+            if missing:
+                self._fetch(missing)
 
-                    if local_mins_high_mode > 5:
-                        local_mins = local_mins_high_mode
+            blocks = []
+            for b in needed.tolist():
+                self._blocks.move_to_end(b)
+                blocks.append(self._blocks[b])
 
-                    self.instability_mode[plane][bunch] = local_mins / 2
+        pos = np.searchsorted(needed, sta // self.block_size) * self.block_size + sta % self.block_size
+        return (np.concatenate(blocks), pos)
+
+    def _fetch(self, blocks):
+        '''Read blocks with a union of hyperslabs in a single HDF5 read'''
+        blocks = sorted(set(blocks))
+        sta = np.array(blocks) * self.block_size
+        end = np.minimum(sta + self.block_size, self.size)
+
+        file_space = self._dataset.id.get_space()
+        file_space.select_none()
+        for s, e in zip(sta, end):
+            file_space.select_hyperslab((int(s),), (1,), block=(int(e - s),), op=h5py.h5s.SELECT_OR)
+
+        data = np.empty(int(np.sum(end - sta)), dtype=self._dataset.dtype)
+        mem_space = h5py.h5s.create_simple(data.shape)
+        self._dataset.id.read(mem_space, file_space, data)
+        data.flags.writeable = False
+        self.reads += 1
+
+        pos = np.concatenate(([0], np.cumsum(end - sta)))
+        for i, b in enumerate(blocks):
+            self._blocks[b] = data[pos[i]:pos[i + 1]]
+            self._blocks.move_to_end(b)
+
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
 
 
 class BQHTDataset(object):
-    def __init__(self, dataset):
+    def __init__(self, dataset, memmap=False):
         '''A Head-Tail dataset
 
         Args:
             dataset:    HDF5 dataset
+            memmap:     memory map the dataset if it is contiguous and not
+                        filtered, the samples are then read as views of the
+                        file without going through HDF5 or the block cache
         '''
         self._dataset = dataset
+        self._memmap = self._open_memmap(dataset) if memmap else None
         self.size = dataset.size
         self.shape = dataset.shape
         self.segments = int(dataset.attrs.get('segment_count', 1))
@@ -734,6 +1290,8 @@ class BQHTDataset(object):
         self.trigger_delay = float(dataset.attrs.get('trigger_delay', 0.0))
         self.deskew = (float(dataset.attrs.get('deskew', 0)) + float(dataset.attrs.get('delay', 0))) * self.period
         self.mean = None
+        self.mean_cache_size = 8
+        self._mean_cache = OrderedDict()
         self.remove_baseline = False
         self.offset = 0
         self.harmonic = 0
@@ -748,6 +1306,19 @@ class BQHTDataset(object):
         self.signal = None
         self.align = False
 
+        # Block cache for small reads, aligned to the chunks of the dataset.
+        # Reads spanning many blocks which are mostly not needed bypass the
+        # cache, see _read_blocks. It only pays off when reads have a high
+        # latency or are repeated, e.g. browsing files on EOS or NFS, so it
+        # is disabled unless cache_size is set.
+        self.cache_size = 0
+        self.cache_block_size = 2**12
+        self.cache_bypass = 0
+        self._cache = None
+        self._cache_settings = None
+        self._xaxis_cache = OrderedDict()
+        self._scratch = np.empty(0, dtype=np.float32)
+
         # Turn adjust as implemented by Acquiris
         if self.turn_adjust is not None:
             turn_adjust_0 = self.turn_adjust[0]
@@ -756,13 +1327,89 @@ class BQHTDataset(object):
     def __repr__(self):
         return '<BQHTDataset: {0}.{1}>'.format(self.plane, self.signal)
 
-    def get(self, turn, first_bunch, last_bunch, **kwargs):
+    @staticmethod
+    def _open_memmap(dataset):
+        '''Returns a memory map of the dataset, or None if it is not stored
+        contiguously without filters'''
+        plist = dataset.id.get_create_plist()
+        if plist.get_layout() != h5py.h5d.CONTIGUOUS or plist.get_nfilters() > 0 or \
+                plist.get_external_count() > 0:
+            return None
+
+        offset = dataset.id.get_offset()
+        if offset is None or dataset.size == 0:
+            return None
+
+        return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=(dataset.size,))
+
+    @property
+    def memmapped(self):
+        return self._memmap is not None
+
+    @property
+    def cache(self):
+        '''Block cache, or None if it is disabled (cache_size = 0) or the
+        dataset is memory mapped'''
+        if self.cache_size <= 0 or self._memmap is not None:
+            return None
+
+        if self._cache is None or self._cache_settings != (self.cache_size, self.cache_block_size):
+            # Blocks hold a whole number of chunks
+            chunk = self._dataset.chunks[0] if self._dataset.chunks else 1
+            block_size = chunk * max(1, int(np.ceil(self.cache_block_size / chunk)))
+            self._cache = BQHTBlockCache(self._dataset, block_size, self.cache_size)
+            self._cache_settings = (self.cache_size, self.cache_block_size)
+
+        return self._cache
+
+    @property
+    def cache_stats(self):
+        '''Counters of the block cache, for tuning'''
+        # An empty cache is falsy, so it is compared with None
+        cache = self._cache
+        if cache is None:
+            return {'hits': 0, 'misses': 0, 'reads': 0, 'bypass': int(self.cache_bypass), 'blocks': 0,
+                    'block_size': 0}
+
+        return {
+            'hits': int(cache.hits),
+            'misses': int(cache.misses),
+            'reads': int(cache.reads),
+            'bypass': int(self.cache_bypass),
+            'blocks': len(cache),
+            'block_size': int(cache.block_size),
+        }
+
+    def clear_cache(self):
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _read(self, sta, end):
+        '''Read raw samples sta to end, as dataset[sta:end]'''
+        if self._memmap is not None and sta >= 0:
+            return self._memmap[sta:end]
+
+        cache = self.cache
+        if cache is None or sta < 0:
+            return self._dataset[sta:end]
+        return cache.read(sta, min(end, self.size))
+
+    def get(self, turn, first_bunch, last_bunch, out=None, x_out=None, **kwargs):
         '''Get bunch data
 
+        All arithmetic is done in float32 and in place, when out and x_out
+        are given no arrays are allocated for the result, so that sweeping
+        over the turns of a file allocates a constant number of arrays.
+
         Args:
             turn (int):         turn number
             first_bunch (int):  first bunch number
             last_bunch (int):   last bunch number
+            out (array):        float32 array for the data, with one element
+                                per sample of the x axis
+            x_out (array):      float32 array for the x axis when the signal
+                                is not aligned, when it is aligned a cached
+                                read-only x axis is returned
 
         Optional args:
             skip (int):         skip N samples at beginning of data
@@ -783,9 +1430,9 @@ class BQHTDataset(object):
         deskew = self.t_to_samples(self.deskew)
 
         x_offset = skip + int(bunch_inc * first_bunch) + 1
-        x_length = int(bunch_inc * (last_bunch - first_bunch + 1)) + extra
+        x_length = self.get_length(first_bunch, last_bunch, extra)
 
-        xaxis = np.arange((x_offset - 1), (x_offset + x_length), dtype=np.float32)
+        xaxis, xtime = self._get_xaxis(x_offset, x_length)
 
         if self.remove_jitter and self.turn_adjust is not None and turn < len(self.turn_adjust):
             turn_adjust = self.turn_adjust[turn]
@@ -793,49 +1440,300 @@ class BQHTDataset(object):
             turn_adjust = 0
 
         turn_inc = turn * self.samples_per_turn + turn_adjust
-        turn_cor = turn_inc % 1
+        turn_cor = np.float32(turn_inc % 1)
 
         bunch_sta = int(turn_inc) + x_offset + deskew + self.trigger_offset
         bunch_end = bunch_sta + x_length
 
-        if align:
-            y = self.convert_data(self._dataset[bunch_sta:bunch_end+1])
-
-            x_interp = np.arange((x_offset - turn_cor), (x_offset + x_length - turn_cor + 1), dtype=np.float32)
-            x_interp = x_interp[0:y.size]
-            x = xaxis[1:]
+        if out is None:
+            out = np.empty(x_length, dtype=np.float32)
 
-            if y.size > 1:
-                y_interp = interp1d(x_interp, y, assume_sorted=True, bounds_error=False)
-                y = y_interp(x[0:y.size-1])
+        if align:
+            x = xtime
+            raw = self._read(bunch_sta, bunch_end + 1)
+
+            if raw.size > 1:
+                # Interpolate at the samples of the x axis, which are turn_cor
+                # after the samples read
+                size = raw.size - 1
+                data = self.convert_data(raw, out=self._get_scratch(raw.size))
+                np.multiply(data[:-1], 1 - turn_cor, out=out[:size])
+                data[1:] *= turn_cor
+                out[:size] += data[1:]
+            else:
+                size = raw.size
+                self.convert_data(raw, out=out[:size])
         else:
-            x = xaxis[1:] - turn_cor
-            y = self.convert_data(self._dataset[bunch_sta:bunch_end])
-
-        if pad and y.size < x.size:
-            y = np.pad(y, (0, x.size - y.size), 'constant')
+            if x_out is None:
+                x_out = np.empty(x_length, dtype=np.float32)
+            x = np.subtract(xaxis[1:], turn_cor, out=x_out)
+            x *= np.float32(self.period)
+
+            raw = self._read(bunch_sta, bunch_end)
+            size = raw.size
+            self.convert_data(raw, out=out[:size])
+
+        if pad:
+            out[size:] = 0
+            y = out
+        else:
+            y = out[:size]
 
         if baseline and turn in self.populated_turns:
             if self.mean is None:
                 self.calc_mean()
 
             if not align and turn > 0:
-                y_interp = interp1d(xaxis, self.mean[(x_offset - 1):(x_offset + x_length)], assume_sorted=True,
-                                    bounds_error=False)
-                x_interp = np.arange((x_offset - turn_cor), (x_offset + x_length - turn_cor), dtype=np.float32)
+                # Interpolate the mean at the samples of the turn
+                mean = self.mean[(x_offset - 1):(x_offset + y.size)]
+                size = min(y.size, mean.size - 1)
+                scratch = self._get_scratch(size)
+                y[:size] -= np.multiply(mean[:size], turn_cor, out=scratch)
+                y[:size] -= np.multiply(mean[1:(size + 1)], 1 - turn_cor, out=scratch)
+            else:
+                mean = self.mean[x_offset:(x_offset + y.size)]
+                y[:mean.size] -= mean
+
+        if invert:
+            np.negative(y, out=y)
 
-                y = y - y_interp(x_interp)
+        return (x, y)
+
+    def get_length(self, first_bunch, last_bunch, extra=0):
+        '''Returns the number of samples returned by get'''
+        return int(self.samples_per_bunch * (last_bunch - first_bunch + 1)) + extra
+
+    def _get_xaxis(self, x_offset, x_length):
+        '''Returns the cached sample numbers from x_offset - 1 and the times
+        from x_offset of a block of x_length samples'''
+        key = (x_offset, x_length)
+        if key in self._xaxis_cache:
+            self._xaxis_cache.move_to_end(key)
+            return self._xaxis_cache[key]
+
+        xaxis = np.arange((x_offset - 1), (x_offset + x_length), dtype=np.float32)
+        xtime = xaxis[1:] * np.float32(self.period)
+        xaxis.flags.writeable = False
+        xtime.flags.writeable = False
+
+        self._xaxis_cache[key] = (xaxis, xtime)
+        while len(self._xaxis_cache) > 16:
+            self._xaxis_cache.popitem(last=False)
+
+        return (xaxis, xtime)
+
+    def _get_scratch(self, size):
+        '''Returns a float32 scratch array of size elements'''
+        if self._scratch.size < size:
+            self._scratch = np.empty(size, dtype=np.float32)
+        return self._scratch[:size]
+
+    def get_turns(self, turns, first_bunch, last_bunch, **kwargs):
+        '''Get bunch data for a block of turns
+
+        All turns are read from the file in a single HDF5 read and the
+        sub-sample alignment is done for every turn at once.
+
+        Args:
+            turns (list):       turn numbers
+            first_bunch (int):  first bunch number
+            last_bunch (int):   last bunch number
+
+        Optional args:
+            skip (int):         skip N samples at beginning of data
+            extra (int):        return M extra samples at end of data
+            baseline (bool):    perform baseline removal
+            invert (bool):      invert the signal
+            align (bool):       align the signal to the same samples
+
+        Returns:
+            A tuple (x, y) where y is a 2D array with one row per turn, if
+            the data is not aligned x also has one row per turn
+        '''
+        skip = kwargs.get('skip', self.t_to_samples(self.offset))
+        extra = kwargs.get('extra', 0)
+
+        x_offset = skip + int(self.samples_per_bunch * first_bunch) + 1
+        x_length = int(self.samples_per_bunch * (last_bunch - first_bunch + 1)) + extra
+
+        x, y = self._get_blocks(turns, [x_offset], x_length, **kwargs)
+
+        return (x[..., 0, :], y[:, 0])
+
+    def get_bunches(self, turns, bunches, **kwargs):
+        '''Get data of several bunches for a block of turns
+
+        As get_turns, but for a list of (not necessarily consecutive) bunches.
+
+        Args:
+            turns (list):       turn numbers
+            bunches (list):     bunch numbers
+
+        Optional args:
+            skip (int):         skip N samples at beginning of data
+            extra (int):        return M extra samples at end of data
+            baseline (bool):    perform baseline removal
+            invert (bool):      invert the signal
+            align (bool):       align the signal to the same samples
+
+        Returns:
+            A tuple (x, y) where y is a 3D array indexed by turn, bunch and
+            sample, if the data is not aligned x also has one row per turn
+        '''
+        skip = kwargs.get('skip', self.t_to_samples(self.offset))
+        extra = kwargs.get('extra', 0)
+
+        x_offsets = [skip + int(self.samples_per_bunch * bunch) + 1 for bunch in bunches]
+        x_length = int(self.samples_per_bunch) + extra
+
+        return self._get_blocks(turns, x_offsets, x_length, **kwargs)
+
+    def _get_blocks(self, turns, x_offsets, x_length, **kwargs):
+        '''Get blocks of x_length samples at x_offsets for several turns'''
+        baseline = kwargs.get('baseline', self.remove_baseline)
+        invert = kwargs.get('invert', self.invert)
+        align = kwargs.get('align', self.align)
+
+        turns = np.asarray(turns, dtype=int)
+        x_offsets = np.asarray(x_offsets, dtype=int)
+
+        deskew = self.t_to_samples(self.deskew)
+
+        x = (x_offsets[:, np.newaxis] + np.arange(x_length)).astype(np.float32)
+
+        turn_adjust = np.zeros(turns.size)
+        if self.remove_jitter and self.turn_adjust is not None:
+            valid = turns < len(self.turn_adjust)
+            turn_adjust[valid] = np.asarray(self.turn_adjust)[turns[valid]]
+
+        turn_inc = turns * self.samples_per_turn + turn_adjust
+        turn_cor = (turn_inc % 1).astype(np.float32)[:, np.newaxis, np.newaxis]
+
+        bunch_sta = (turn_inc.astype(int) + deskew + self.trigger_offset)[:, np.newaxis] + x_offsets
+        shape = bunch_sta.shape
+
+        if align:
+            # Read one extra sample per turn for the interpolation
+            y = self.convert_data(self._read_blocks(bunch_sta.ravel(), x_length + 1)).reshape(shape + (-1,))
+            y = y[..., :-1] * (1 - turn_cor) + y[..., 1:] * turn_cor
+        else:
+            x = x - turn_cor
+            y = self.convert_data(self._read_blocks(bunch_sta.ravel(), x_length)).reshape(shape + (-1,))
+
+        if baseline:
+            if self.mean is None:
+                self.calc_mean()
+
+            populated = np.isin(turns, self.populated_turns)
+            mean = self.mean[x_offsets[:, np.newaxis] + np.arange(-1, x_length)]
+
+            if align:
+                y[populated] -= mean[:, 1:]
             else:
-                y = y - self.mean[x_offset:(x_offset + x_length)]
+                # Interpolate the mean at the samples of each turn
+                mean_cor = np.where(turns[:, np.newaxis, np.newaxis] > 0, turn_cor, 0)[populated]
+                y[populated] -= mean[:, :-1] * mean_cor + mean[:, 1:] * (1 - mean_cor)
 
         if invert:
             y = -y
 
         return (x * self.period, y)
 
-    def convert_data(self, data):
-        '''Returns data converted from raw samples to volts'''
-        return (np.float32(data) - self.data_offset) * self.data_resolution
+    def _read_blocks(self, starts, length):
+        '''Read blocks of raw samples in a single HDF5 read
+
+        Args:
+            starts (list):  first sample of each block
+            length (int):   number of samples in each block
+
+        Returns:
+            A 2D array with one row per block, samples outside of the dataset
+            are set to zero
+        '''
+        starts = np.asarray(starts, dtype=int)
+        blocks = np.zeros((starts.size, length), dtype=self._dataset.dtype)
+
+        # Limit the blocks to the dataset
+        sta = np.clip(starts, 0, self.size)
+        end = np.clip(starts + length, 0, self.size)
+        valid = np.flatnonzero(end > sta)
+
+        if valid.size == 0:
+            return blocks
+
+        order = valid[np.argsort(sta[valid], kind='stable')]
+        sta = sta[order]
+        end = end[order]
+
+        if self._memmap is not None:
+            # Gather many short blocks at once, long blocks are faster to copy
+            # one by one
+            full = ((end - sta) == length) & (length < 1024)
+            blocks[order[full]] = self._memmap[sta[full, np.newaxis] + np.arange(length)]
+            for i in np.flatnonzero(~full):
+                s = sta[i] - starts[order[i]]
+                blocks[order[i], s:(s + end[i] - sta[i])] = self._memmap[sta[i]:end[i]]
+            return blocks
+
+        # Read through the block cache if the blocks are cached, or if they
+        # would not read too many samples which are not needed
+        cache = self.cache
+        if cache is not None:
+            max_missing = min(cache.max_blocks // 2, 256)
+            needed = cache.blocks(sta, end)
+            missing = needed.size - len(cache)
+            if missing <= max_missing:
+                missing = sum(1 for b in needed.tolist() if b not in cache)
+
+            if missing == 0 or (missing <= max_missing and missing * cache.block_size <= 4 * np.sum(end - sta)):
+                data, pos = cache.read_blocks(sta, end)
+
+                full = (end - sta) == length
+                blocks[order[full]] = data[pos[full, np.newaxis] + np.arange(length)]
+                for i in np.flatnonzero(~full):
+                    s = sta[i] - starts[order[i]]
+                    blocks[order[i], s:(s + end[i] - sta[i])] = data[pos[i]:(pos[i] + end[i] - sta[i])]
+                return blocks
+
+            self.cache_bypass += 1
+
+        if np.all(sta[1:] >= end[:-1]):
+            # Non-overlapping blocks, select just the samples needed with a
+            # union of hyperslabs to avoid reading the samples in between
+            file_space = self._dataset.id.get_space()
+            file_space.select_none()
+            for s, e in zip(sta, end):
+                file_space.select_hyperslab((int(s),), (1,), block=(int(e - s),), op=h5py.h5s.SELECT_OR)
+
+            data = np.empty(int(np.sum(end - sta)), dtype=self._dataset.dtype)
+            mem_space = h5py.h5s.create_simple(data.shape)
+            self._dataset.id.read(mem_space, file_space, data)
+        else:
+            # Overlapping blocks, read the whole span at once
+            data = self._dataset[sta[0]:end.max()]
+            data = np.concatenate([data[(s - sta[0]):(e - sta[0])] for s, e in zip(sta, end)])
+
+        # Split back into blocks
+        if data.size == order.size * length:
+            blocks[order] = data.reshape(order.size, length)
+        else:
+            pos = np.concatenate(([0], np.cumsum(end - sta)))
+            for i, b in enumerate(order):
+                s = sta[i] - starts[b]
+                blocks[b, s:(s + end[i] - sta[i])] = data[pos[i]:pos[i + 1]]
+
+        return blocks
+
+    def convert_data(self, data, out=None):
+        '''Returns data converted from raw samples to volts
+
+        Args:
+            data:   raw samples
+            out:    float32 array for the result
+        '''
+        out = np.subtract(data, np.float32(self.data_offset), out=out, dtype=np.float32)
+        out *= np.float32(self.data_resolution)
+        return out
 
     def __getitem__(self, slicer):
         '''Get bunch data with slicing interface.
@@ -870,23 +1768,80 @@ class BQHTDataset(object):
         '''Convert a time to samples'''
         return int(np.round(t / self.period))
 
-    def calc_mean(self):
-        '''Calculate the mean for baseline subtraction'''
-        xx = np.arange(0, int(self.samples_per_bunch * self.number_of_bunches +
-                              self.t_to_samples(self.max_offset)), dtype=np.float32) * self.period
-        yy = np.zeros_like(xx)
-
-        for i in self.populated_turns:
-            x, y = self.get(i, 0, self.number_of_bunches - 1, skip=-1, extra=self.t_to_samples(self.max_offset) + 1,
-                            baseline=False, align=False, invert=False)
-            if i == 0:
-                xx = x[:-1]
-                yy = y[:-1]
-            else:
-                y_interp = interp1d(x, y, assume_sorted=True)
-                yy += y_interp(xx)
+    def _mean_turns(self):
+        '''Returns the turns of the mean and their adjustment'''
+        turns = np.asarray(self.populated_turns, dtype=int)
+
+        turn_adjust = np.zeros(turns.size)
+        if self.remove_jitter and self.turn_adjust is not None:
+            valid = turns < len(self.turn_adjust)
+            turn_adjust[valid] = np.asarray(self.turn_adjust)[turns[valid]]
+
+        return (turns, turn_adjust)
+
+    def _mean_key(self, turns=None, turn_adjust=None):
+        '''Returns the key of the mean in the mean cache'''
+        if turns is None:
+            turns, turn_adjust = self._mean_turns()
+        return _digest(self.frev, self.harmonic, self.max_offset, self.deskew, self.trigger_offset,
+                       turns, turn_adjust)
+
+    def _state_key(self):
+        '''Returns a digest of the settings the sample positions depend on'''
+        turn_adjust = None
+        if self.remove_jitter and self.turn_adjust is not None:
+            turn_adjust = np.asarray(self.turn_adjust, dtype=float)
+        return _digest(self.frev, self.harmonic, self.offset, self.max_offset, turn_adjust)
+
+    def calc_mean(self, block_turns=64):
+        '''Calculate the mean for baseline subtraction
+
+        The turns are processed in blocks of block_turns, each turn being
+        interpolated to the samples of the first turn. The last
+        mean_cache_size results are cached, so that going back to previous
+        frev values does not recompute the mean.
+
+        Args:
+            block_turns (int):  number of turns read at once
+        '''
+        turns, turn_adjust = self._mean_turns()
+        key = self._mean_key(turns, turn_adjust)
+
+        if key in self._mean_cache:
+            self._mean_cache.move_to_end(key)
+            self.mean = self._mean_cache[key]
+            return
+
+        length = int(self.samples_per_bunch * self.number_of_bunches + self.t_to_samples(self.max_offset))
+
+        # Shift of each turn relative to the samples of the first turn
+        turn_inc = turns * self.samples_per_turn + turn_adjust
+        turn_cor = turn_inc % 1
+        shift = turn_cor - (turn_cor[0] if turns.size and turns[0] == 0 else 0)
+        shift_int = np.floor(shift)
+
+        turn_sta = (turn_inc.astype(int) + shift_int.astype(int) +
+                    self.t_to_samples(self.deskew) + self.trigger_offset)
+        turn_cor = (shift - shift_int).astype(np.float32)[:, np.newaxis]
+
+        total = np.zeros(length, dtype=np.float64)
+        buffer = np.empty((min(block_turns, turns.size), length), dtype=np.float32)
+
+        for block in range(0, turns.size, block_turns):
+            sl = slice(block, block + block_turns)
+            y = self.convert_data(self._read_blocks(turn_sta[sl], length + 1))
+
+            # Linear interpolation of all turns in the block at once
+            interp = buffer[:y.shape[0]]
+            np.multiply(y[:, :-1], 1 - turn_cor[sl], out=interp)
+            interp += y[:, 1:] * turn_cor[sl]
+            total += np.sum(interp, axis=0, dtype=np.float64)
+
+        self.mean = (total / len(self.populated_turns)).astype(np.float32)
 
-        self.mean = yy / len(self.populated_turns)
+        self._mean_cache[key] = self.mean
+        while len(self._mean_cache) > self.mean_cache_size:
+            self._mean_cache.popitem(last=False)
 
     @property
     def number_of_bunches(self):
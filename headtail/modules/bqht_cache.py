@@ -1,46 +1,238 @@
 # -*- coding: utf-8 -*-
 
+import pathlib
 import pickle
 import sqlite3
 
 
 class Cache(object):
-    def __init__(self, path, writeable=False):
+    # Columns with the maximum stability ratio of each plane
+    ratios = {
+        'horizontal': 'h_ratio',
+        'vertical': 'v_ratio',
+    }
+
+    def __init__(self, path, writeable=False, wal=False):
+        '''Cache of the bunch stability of processed files
+
+        Files are stored in the cache table, together with their time stamp,
+        user, cycle, number of bunches and maximum max/min amplitude ratio of each
+        plane. The stability of each of their bunches is stored in the
+        stability table.
+
+        Args:
+            path:       path of the SQLite database
+            writeable:  allow writing to the cache, the cache is upgraded and
+                        its journal mode set when it is opened writeable,
+                        otherwise it is opened read-only
+            wal:        use write-ahead logging, this requires all processes
+                        using the cache to run on the same host, so it must
+                        not be used for caches on network file systems
+        '''
         self.path = path
         self.writeable = writeable
+        self.wal = wal
         self._init()
 
     def __getstate__(self):
-        return {'path': self.path, 'writeable': self.writeable}
+        return {'path': self.path, 'writeable': self.writeable, 'wal': self.wal}
 
     def __setstate__(self, state):
         self.__dict__ = state
         self._init()
 
     def _init(self):
-        self.db = sqlite3.connect(self.path)
+        if self.writeable:
+            self.db = sqlite3.connect(self.path)
+        else:
+            self.db = sqlite3.connect('{0}?mode=ro'.format(pathlib.Path(self.path).absolute().as_uri()), uri=True)
         self.cursor = self.db.cursor()
+        # Wait for writers instead of failing while they hold the lock
+        self.cursor.execute('PRAGMA busy_timeout = 10000')
         if self.writeable:
-            self.cursor.execute('PRAGMA busy_timeout = 10000')
-            self.cursor.execute('CREATE table IF NOT EXISTS cache (name TEXT PRIMARY KEY, bunches BLOB);')
-            self.db.commit()
+            # The journal mode is stored in the database, so a cache which
+            # used write-ahead logging is switched back
+            self.cursor.execute('PRAGMA journal_mode = {0}'.format('WAL' if self.wal else 'DELETE'))
+            with self.db:
+                # Take the write lock immediately, upgrading a read lock would
+                # fail without waiting for the busy timeout
+                self.cursor.execute('BEGIN IMMEDIATE')
+                self.cursor.execute('CREATE table IF NOT EXISTS cache (name TEXT PRIMARY KEY, bunches BLOB, '
+                                    'stamp TEXT, user TEXT, cycle TEXT, bunch_count INTEGER, h_ratio REAL, '
+                                    'v_ratio REAL);')
+                self.cursor.execute('CREATE table IF NOT EXISTS stability (name TEXT, bunch INTEGER, '
+                                    'h_min REAL, h_max REAL, v_min REAL, v_max REAL, PRIMARY KEY (name, bunch));')
+                self._migrate()
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS cache_stamp ON cache (stamp);')
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS cache_user ON cache (user, stamp);')
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS cache_cycle ON cache (cycle, stamp);')
+                for ratio in self.ratios.values():
+                    self.cursor.execute('CREATE INDEX IF NOT EXISTS cache_{0} ON cache ({0});'.format(ratio))
+
+    def _migrate(self):
+        '''Upgrade older caches
+
+        Adds the time stamp, user, cycle and stability summary columns and
+        moves pickled bunches to the stability table. The cycle of files
+        cached before it was recorded is not known.
+        '''
+        columns = [c[1] for c in self.cursor.execute('PRAGMA table_info(cache)').fetchall()]
+        for column, column_type in (('stamp', 'TEXT'), ('user', 'TEXT'), ('cycle', 'TEXT'),
+                                    ('bunch_count', 'INTEGER'), ('h_ratio', 'REAL'), ('v_ratio', 'REAL')):
+            if column not in columns:
+                self.cursor.execute('ALTER TABLE cache ADD COLUMN {0} {1}'.format(column, column_type))
+
+        names = [v for (v,) in self.cursor.execute('SELECT name FROM cache WHERE stamp IS NULL').fetchall()]
+        self.cursor.executemany('UPDATE cache SET stamp = ?, user = ? WHERE name == ?',
+                                [self.parse_name(name) + (name,) for name in names])
+
+        rows = self.cursor.execute('SELECT name, bunches FROM cache WHERE bunches IS NOT NULL').fetchall()
+        self._insert_stability([(name, pickle.loads(bunches)) for name, bunches in rows])
+        self.cursor.executemany('UPDATE cache SET bunches = NULL WHERE name == ?', [(name,) for name, _ in rows])
+
+        self.cursor.execute(
+            'UPDATE cache SET '
+            'bunch_count = (SELECT COUNT(1) FROM stability s WHERE s.name == cache.name), '
+            'h_ratio = (SELECT MAX(h_max / h_min) FROM stability s WHERE s.name == cache.name), '
+            'v_ratio = (SELECT MAX(v_max / v_min) FROM stability s WHERE s.name == cache.name) '
+            'WHERE bunch_count IS NULL'
+        )
+
+    @staticmethod
+    def parse_name(name):
+        '''Returns the time stamp and user from a file name
+
+        File names have the format "DEVICE[_USER]_YYYYMMDD_HHMMSS.h5".
+        '''
+        prefix = name[:-19].split('_', 1)
+        return (name[-18:-3], prefix[1] if len(prefix) > 1 else None)
+
+    @staticmethod
+    def _summary(bunches):
+        '''Returns the number of bunches and maximum ratio of each plane'''
+        h_ratio = [h_max / h_min for h_min, h_max, _, _ in bunches.values() if h_min != 0]
+        v_ratio = [v_max / v_min for _, _, v_min, v_max in bunches.values() if v_min != 0]
+        return (len(bunches), float(max(h_ratio)) if h_ratio else None, float(max(v_ratio)) if v_ratio else None)
+
+    def _insert_stability(self, items):
+        self.cursor.executemany('INSERT INTO stability VALUES (?, ?, ?, ?, ?, ?)', [
+            (name, int(bunch)) + tuple(float(v) for v in values)
+            for name, bunches in items for bunch, values in bunches.items()
+        ])
 
     def delete(self, name):
+        self.delete_many([name])
+
+    def delete_many(self, names):
+        '''Delete several files in a single transaction'''
         if self.writeable:
-            self.cursor.execute('DELETE FROM cache WHERE name == ?', (name,))
-            self.db.commit()
+            names = [(name,) for name in names]
+            with self.db:
+                self.cursor.executemany('DELETE FROM cache WHERE name == ?', names)
+                self.cursor.executemany('DELETE FROM stability WHERE name == ?', names)
+
+    def insert(self, name, bunches, cycle=None):
+        self.insert_many([(name, bunches, cycle)])
 
-    def insert(self, name, bunches):
+    def insert_many(self, items):
+        '''Insert several files in a single transaction
+
+        Args:
+            items:  list of (name, bunches) or (name, bunches, cycle) tuples,
+                    where bunches is a dict of bunch: (h_min, h_max, v_min,
+                    v_max)
+        '''
         if self.writeable:
-            self.cursor.execute('INSERT INTO cache VALUES (?, ?)', (name, pickle.dumps(bunches)))
-            self.db.commit()
+            items = [(item[0], item[1], item[2] if len(item) > 2 else None) for item in items]
+            with self.db:
+                self.cursor.executemany(
+                    'INSERT INTO cache (name, stamp, user, cycle, bunch_count, h_ratio, v_ratio) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(name,) + self.parse_name(name) + (cycle,) + self._summary(bunches)
+                     for name, bunches, cycle in items]
+                )
+                self._insert_stability([(name, bunches) for name, bunches, _ in items])
 
     def get_names(self):
         return [v for (v,) in self.cursor.execute('SELECT name from cache').fetchall()]
 
     def get_for_name(self, name):
-        res = self.cursor.execute('SELECT * FROM cache WHERE name == ? LIMIT 1', (name,)).fetchall()
-        return None if len(res) == 0 else {'name': res[0][0], 'bunches': pickle.loads(res[0][1])}
+        res = self.cursor.execute('SELECT name, bunches FROM cache WHERE name == ? LIMIT 1', (name,)).fetchall()
+        if len(res) == 0:
+            return None
+
+        # Older caches which have not been migrated yet
+        if res[0][1] is not None:
+            return {'name': res[0][0], 'bunches': pickle.loads(res[0][1])}
+
+        rows = self.cursor.execute('SELECT bunch, h_min, h_max, v_min, v_max FROM stability WHERE name == ? '
+                                   'ORDER BY bunch', (name,)).fetchall()
+        return {'name': res[0][0], 'bunches': {bunch: tuple(values) for bunch, *values in rows}}
+
+    def missing_columns(self, columns):
+        '''Returns the columns missing from the cache table, which is only
+        upgraded when the cache is opened writeable by bqht_filter'''
+        existing = [c[1] for c in self.cursor.execute('PRAGMA table_info(cache)').fetchall()]
+        return [column for column in columns if column not in existing]
+
+    def query(self, start=None, end=None, user=None, cycle=None, plane=None, ratio=None):
+        '''Query the cached files
+
+        Args:
+            start:  earliest file time (datetime)
+            end:    latest file time (datetime)
+            user:   user of the files
+            cycle:  cycle of the files, files cached before the cycle was
+                    recorded have none
+            plane:  plane for the ratio ('horizontal' or 'vertical', None for
+                    any plane)
+            ratio:  only files with at least one bunch with a max/min
+                    amplitude ratio greater or equal to ratio
+
+        Returns:
+            A list of (name, bunches, h_ratio, v_ratio) tuples sorted by time,
+            where the ratios are the maximum over the bunches of the file
+
+        Raises:
+            ValueError: if the cache has an older format, which cannot be
+                        upgraded as it is not writeable
+            sqlite3.DatabaseError: if the cache cannot be read, e.g. it is locked
+        '''
+        missing = self.missing_columns(['stamp', 'user', 'bunch_count', 'h_ratio', 'v_ratio'] +
+                                       (['cycle'] if cycle is not None else []))
+        if missing:
+            raise ValueError('cache {0} has an older format without {1}, run bqht_filter to upgrade '
+                             'it'.format(self.path, ', '.join(missing)))
+
+        where = []
+        params = []
+
+        if start is not None:
+            where.append('stamp >= ?')
+            params.append(start.strftime('%Y%m%d_%H%M%S'))
+
+        if end is not None:
+            where.append('stamp <= ?')
+            params.append(end.strftime('%Y%m%d_%H%M%S'))
+
+        if user is not None:
+            where.append('user == ?')
+            params.append(user)
+
+        if cycle is not None:
+            where.append('cycle == ?')
+            params.append(cycle)
+
+        if ratio is not None:
+            planes = self.ratios.keys() if plane is None else [plane]
+            where.append('({0})'.format(' OR '.join('{0} >= ?'.format(self.ratios[p]) for p in planes)))
+            params.extend([ratio] * len(planes))
+
+        return self.cursor.execute(
+            'SELECT name, bunch_count, h_ratio, v_ratio FROM cache {0} ORDER BY stamp, name'.format(
+                'WHERE ' + ' AND '.join(where) if where else ''
+            ), params
+        ).fetchall()
 
     def is_cached(self, name):
         res = self.cursor.execute('SELECT COUNT(1) FROM cache WHERE name == ? LIMIT 1', (name,)).fetchall()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+class MinMaxPyramid(object):
+    def __init__(self, x, y, factor=4, min_length=64):
+        '''Multi-resolution min/max decimation of traces
+
+        Each level holds the minimum and maximum of blocks of factor times
+        more samples than the previous level, the samples themselves being
+        the finest level. Traces are drawn from the coarsest level which
+        still has a block for each pixel of the visible range, so the number
+        of points drawn does not depend on the number of samples, while the
+        peaks of the traces are kept.
+
+        Args:
+            x:          (traces, samples) array of increasing X values
+            y:          (traces, samples) array of Y values
+            factor:     number of blocks of a level combined in the next
+            min_length: smallest number of blocks of a level
+        '''
+        self.x = x
+        self.y = y
+        self.factor = factor
+        self.levels = []
+
+        # Each level is a (block, mins, maxs) tuple, where block is the
+        # number of samples in each block
+        block = 1
+        mins = maxs = y
+        while mins.shape[1] > min_length * factor:
+            pad = -mins.shape[1] % factor
+            if pad:
+                mins = np.pad(mins, ((0, 0), (0, pad)), mode='edge')
+                maxs = np.pad(maxs, ((0, 0), (0, pad)), mode='edge')
+            shape = (mins.shape[0], mins.shape[1] // factor, factor)
+            mins = np.min(mins.reshape(shape), axis=2)
+            maxs = np.max(maxs.reshape(shape), axis=2)
+            block *= factor
+            self.levels.append((block, mins, maxs))
+
+    def _range(self, row, xmin, xmax, pixels):
+        '''Returns the level and range of blocks covering xmin to xmax
+
+        Returns:
+            A (block, mins, maxs, sta, end) tuple, mins and maxs being None
+            for the samples themselves
+        '''
+        x = self.x[row]
+        sta = max(int(np.searchsorted(x, xmin, side='right')) - 1, 0)
+        end = min(int(np.searchsorted(x, xmax, side='left')) + 1, x.size)
+
+        block, mins, maxs = 1, None, None
+        for level in self.levels:
+            if (end - sta) // level[0] < pixels:
+                break
+            block, mins, maxs = level
+
+        return (block, mins, maxs, sta // block, -(-end // block))
+
+    def get(self, row, xmin, xmax, pixels):
+        '''Returns a trace for drawing
+
+        Blocks are drawn as a vertical line from their minimum to their
+        maximum at the position of their first sample.
+
+        Args:
+            row:        trace
+            xmin:       start of the visible range
+            xmax:       end of the visible range
+            pixels:     width of the visible range in pixels
+
+        Returns:
+            A tuple of the X and Y values
+        '''
+        block, mins, maxs, sta, end = self._range(row, xmin, xmax, pixels)
+
+        if mins is None:
+            return (self.x[row, sta:end], self.y[row, sta:end])
+
+        x = self.x[row, ::block][sta:end]
+        return (np.repeat(x, 2), np.column_stack((mins[row, sta:end], maxs[row, sta:end])).ravel())
+
+    def image(self, xmin, xmax, pixels):
+        '''Returns all traces as an image for drawing
+
+        The traces must have the same X values. Each block is represented by
+        its minimum or maximum, whichever is furthest from zero.
+
+        Args:
+            xmin:       start of the visible range
+            xmax:       end of the visible range
+            pixels:     width of the visible range in pixels
+
+        Returns:
+            A tuple of the X values of the first and last sample of the image
+            and the (traces, columns) image
+        '''
+        block, mins, maxs, sta, end = self._range(0, xmin, xmax, pixels)
+
+        if mins is None:
+            data = self.y[:, sta:end]
+        else:
+            data = np.where(-mins[:, sta:end] > maxs[:, sta:end], mins[:, sta:end], maxs[:, sta:end])
+
+        x = self.x[0]
+        return (x[sta * block], x[min(end * block, x.size) - 1], data)
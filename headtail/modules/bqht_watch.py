@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import struct
+import time
+
+
+class Inotify(object):
+    '''Minimal inotify interface, raises OSError if inotify is not available'''
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    def __init__(self):
+        libc = ctypes.util.find_library('c')
+        if libc is None:
+            raise OSError('cannot find libc')
+
+        self._libc = ctypes.CDLL(libc, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'cannot initialise inotify')
+
+        self._watches = {}
+
+    def watch(self, path, mask):
+        if path not in self._watches:
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'cannot watch {0}'.format(path))
+            self._watches[path] = wd
+
+    def unwatch(self, path):
+        wd = self._watches.pop(path, None)
+        if wd is not None:
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    @property
+    def paths(self):
+        return list(self._watches.keys())
+
+    def read(self, timeout):
+        '''Wait up to timeout seconds for events
+
+        Returns:
+            A list of (path, name, mask) tuples
+        '''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        paths = {wd: path for path, wd in self._watches.items()}
+        events = []
+        i = 0
+        while i + 16 <= len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, i)
+            name = data[(i + 16):(i + 16 + length)].rstrip(b'\0')
+            events.append((paths.get(wd), os.fsdecode(name), mask))
+            i += 16 + length
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher(object):
+    def __init__(self, path, pattern, days=2, interval=1.0, inotify=True):
+        '''Watch for new files in the newest day directories
+
+        Only the newest day directories are rescanned, so the cost of a scan
+        does not depend on the size of the archive. Files which have already
+        been returned are kept in the done set, which is limited to the files
+        in these directories.
+
+        Args:
+            path:       data directory, with one sub-directory per day
+            pattern:    glob pattern of the file names
+            days:       number of newest day directories to watch
+            interval:   polling interval in seconds
+            inotify:    wake up on inotify events where available, in
+                        addition to polling (which is still needed for files
+                        written from other hosts on network file systems)
+        '''
+        self.path = path
+        self.pattern = pattern
+        self.days = days
+        self.interval = interval
+        self.done = set()
+        self._sizes = {}
+        self._closed = set()
+        self._inotify = None
+
+        if inotify:
+            try:
+                self._inotify = Inotify()
+                self._inotify.watch(path, Inotify.IN_CREATE)
+            except OSError:
+                if self._inotify is not None:
+                    self._inotify.close()
+                self._inotify = None
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _day_dirs(self):
+        '''Returns the newest day directories'''
+        with os.scandir(self.path) as it:
+            dirs = sorted(entry.path for entry in it if entry.is_dir())
+        return dirs[-self.days:] if self.days > 0 else []
+
+    def wait(self):
+        '''Wait for new files
+
+        Blocks for up to interval seconds, or until a file is written on this
+        host if inotify is available.
+
+        Returns:
+            A list of the paths of the files completed since the previous
+            call, sorted by name
+        '''
+        if self._inotify is not None:
+            for _, name, mask in self._inotify.read(self.interval):
+                if mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                    self._closed.add(name)
+        else:
+            time.sleep(self.interval)
+
+        return self.scan()
+
+    def scan(self):
+        '''Scan the newest day directories for new files
+
+        A file is considered complete once inotify reported it closed, or
+        when its size did not change since the previous scan.
+
+        Returns:
+            A list of the paths of the new complete files, sorted by name
+        '''
+        dirs = self._day_dirs()
+
+        if self._inotify is not None:
+            for path in set(self._inotify.paths) - set(dirs) - {self.path}:
+                self._inotify.unwatch(path)
+            for path in dirs:
+                try:
+                    self._inotify.watch(path, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+                except OSError:
+                    pass
+
+        files = {}
+        for path in dirs:
+            for f in glob.glob(os.path.join(path, self.pattern)):
+                files[os.path.basename(f)] = f
+
+        new = []
+        sizes = {}
+        for name, f in files.items():
+            if name in self.done:
+                continue
+
+            try:
+                size = os.path.getsize(f)
+            except OSError:
+                continue
+
+            if name in self._closed or (size > 0 and self._sizes.get(name) == size):
+                new.append(name)
+            else:
+                sizes[name] = size
+
+        # Only keep track of the files in the watched directories
+        self._sizes = sizes
+        self._closed.intersection_update(files)
+        self.done.intersection_update(files)
+        self.done.update(new)
+
+        return [files[name] for name in sorted(new)]
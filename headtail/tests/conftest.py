@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# The modules are imported as in the scripts, from the headtail directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''
+Compare the vectorised fitness and single segment optimiser with the
+original point by point implementation
+'''
+
+import logging
+
+import numpy as np
+import pytest
+
+from scipy.interpolate import interp1d
+
+from modules import bqht
+
+
+@pytest.fixture
+def htf():
+    # The fitness does not use the file, only an open BQHTFile is needed
+    htf = bqht.BQHTFile.__new__(bqht.BQHTFile)
+    htf.closed = False
+    htf._log = logging.getLogger(__name__)
+    return htf
+
+
+class Dataset(object):
+    '''Single segment dataset with the attributes used by the optimiser'''
+
+    def __init__(self, data, period, nominal, bunch_inc, nb_turns):
+        self._dataset = data
+        self.period = period
+        self.frev = nominal * period
+        self.samples_per_turn = nominal
+        self.samples_per_bunch = bunch_inc
+        self.populated_turns = range(nb_turns)
+        self.offset = 0.0
+        self.deskew = 0.0
+        self.trigger_offset = 0
+
+    def t_to_samples(self, t):
+        return int(np.round(t / self.period))
+
+    def convert_data(self, data):
+        return np.asarray(data, dtype=float)
+
+    def _read(self, sta, end):
+        return self._dataset[sta:end]
+
+
+def bunch(samples, centre, sigma=6.0, amplitude=1000.0):
+    return amplitude * np.exp(-0.5 * ((samples - centre) / sigma)**2)
+
+
+def calculate_fitness(bunch0, bunch1_interp, distance, best_fit, points):
+    '''Original fitness of a single distance, stopping once it is worse
+    than best_fit'''
+    square_diffs = 0.0
+    for p in points:
+        square_diffs = square_diffs + (bunch0[p] - bunch1_interp(p + distance))**2
+        if square_diffs > best_fit:
+            break
+    return square_diffs
+
+
+def reference(bunch0, samp, data, distances, points):
+    '''Fitness of each distance with calculate_fitness'''
+    interp = interp1d(samp, data, assume_sorted=True, bounds_error=False)
+    return np.array([calculate_fitness(bunch0, interp, d, np.inf, points) for d in distances])
+
+
+def reference_optimise(htf, dataset, magnitude=10, iterations=5):
+    '''Original single segment optimiser, with sample points every 3 samples'''
+    nb_turns = len(dataset.populated_turns)
+
+    first_bunch = htf.bunches[0]
+    repeat_approx = dataset.t_to_samples(dataset.frev)
+    bunch_inc = dataset.samples_per_bunch
+    offset = (dataset.populated_turns[0] * dataset.samples_per_turn +
+              dataset.t_to_samples(dataset.offset) +
+              dataset.t_to_samples(dataset.deskew) +
+              dataset.trigger_offset)
+
+    first_bunch_start = int(offset + first_bunch * bunch_inc)
+    first_bunch_end = int(first_bunch_start + bunch_inc)
+
+    first_bunch_data = np.array(dataset.convert_data(dataset._dataset[first_bunch_start:first_bunch_end]))
+
+    points = htf._generate_points(first_bunch_data, False)
+
+    mag = magnitude
+
+    for j in range(1, iterations + 1):
+        fitness = []
+        distance = 0
+        best_fit = float('inf')
+
+        comp_turn = int(min(10**(j - 1) + 1, nb_turns) - 1)
+
+        comp_bunch_start = int(repeat_approx * comp_turn - 10 * mag * comp_turn)
+        comp_bunch_end = int(comp_bunch_start + bunch_inc + 20 * mag * comp_turn + 1)
+
+        comp_bunch_data = np.array(dataset.convert_data(
+            dataset._dataset[first_bunch_start + comp_bunch_start:first_bunch_start + comp_bunch_end]
+        ))
+
+        comp_bunch_samp = np.arange(comp_bunch_start, comp_bunch_end)
+        comp_bunch_interp = interp1d(comp_bunch_samp, comp_bunch_data, assume_sorted=True, bounds_error=False)
+
+        for i in range(-10, 11):
+            repeat = repeat_approx + (i * mag)
+            new_distance = comp_turn * repeat
+            if new_distance != distance:
+                distance = new_distance
+                fit = calculate_fitness(first_bunch_data, comp_bunch_interp, distance, best_fit, points)
+                fitness.append(fit)
+                best_fit = min(fit, best_fit)
+            else:
+                fitness.append(fitness[-1])
+
+        best_index = fitness.index(min(fitness))
+        repeat_approx += (best_index - 10) * mag
+        mag /= 10
+
+    return repeat_approx * dataset.period
+
+
+def test_fitness_matches_reference(htf):
+    rng = np.random.default_rng(1)
+    bunch0 = bunch(np.arange(50), 25.0) + rng.normal(0, 5, 50)
+
+    # Comparison bunch one turn later, at a fractional distance
+    repeat = 1000.37
+    samp = np.arange(900, 1151)
+    data = bunch(samp, 25.0 + repeat) + rng.normal(0, 5, samp.size)
+
+    points = sorted(rng.choice(50, 20, replace=False).tolist())
+    distances = repeat + np.arange(-10, 11) * 0.1
+
+    fitness = htf._calculate_fitness_array(bunch0, samp, data, distances, points)
+    expected = reference(bunch0, samp, data, distances, points)
+
+    assert np.allclose(fitness, expected, rtol=1e-9)
+    assert np.argmin(fitness) == np.argmin(expected)
+
+
+def test_fitness_outside_comparison_bunch(htf):
+    bunch0 = bunch(np.arange(50), 25.0)
+    samp = np.arange(990, 1060)
+    data = bunch(samp, 1025.0)
+    points = list(range(0, 50, 3))
+
+    # Distances whose points partly fall outside of the comparison bunch
+    distances = np.array([900.0, 990.0, 1000.0, 1010.5, 1011.25, 1100.0])
+
+    fitness = htf._calculate_fitness_array(bunch0, samp, data, distances, points)
+    expected = reference(bunch0, samp, data, distances, points)
+
+    # The reference gives NaN, which would not compare as the worst fit
+    outside = np.isnan(expected)
+    assert outside.tolist() == [True, False, False, False, True, True]
+    assert np.all(np.isposinf(fitness[outside]))
+    assert np.allclose(fitness[~outside], expected[~outside], rtol=1e-9)
+    assert np.argmin(fitness) == 2
+
+
+def test_fitness_invalid_samples(htf):
+    bunch0 = bunch(np.arange(50), 25.0)
+    samp = np.arange(990, 1060)
+    points = list(range(0, 50, 3))
+    distances = np.array([999.0, 1000.0, 1001.0])
+
+    # A NaN in the comparison bunch only spoils the distances which use it,
+    # as in the reference
+    data = bunch(samp, 1025.0)
+    data[20] = np.nan
+
+    fitness = htf._calculate_fitness_array(bunch0, samp, data, distances, points)
+    expected = reference(bunch0, samp, data, distances, points)
+
+    assert np.array_equal(np.isnan(expected), np.isposinf(fitness))
+    assert not np.isnan(fitness).any()
+    assert np.allclose(fitness[np.isfinite(fitness)], expected[np.isfinite(expected)], rtol=1e-9)
+
+    # An infinite sample gives an infinite fitness in both
+    data = bunch(samp, 1025.0)
+    data[1] = np.inf
+    fitness = htf._calculate_fitness_array(bunch0, samp, data, distances, points)
+    expected = reference(bunch0, samp, data, distances, points)
+
+    assert np.array_equal(np.isinf(fitness) | np.isnan(fitness), np.isinf(expected) | np.isnan(expected))
+    assert not np.isnan(fitness).any()
+
+
+@pytest.mark.parametrize('repeat', [1000.37, 999.612, 1003.2048])
+def test_optimiser_matches_reference(htf, repeat):
+    rng = np.random.default_rng(2)
+    period = 1e-10
+    nb_turns = 200
+
+    # One bunch per turn, the nominal repeat value is off by a few samples
+    samples = np.arange(int(nb_turns * repeat) + 100)
+    turn = np.round((samples - 25.0) / repeat)
+    data = bunch(samples, 25.0 + turn * repeat) + rng.normal(0, 5, samples.size)
+    dataset = Dataset(data, period, 1000, 50, nb_turns)
+
+    htf.bunches = [0]
+
+    expected = reference_optimise(htf, dataset)
+    frev, turn_adjust = htf._optimise_overlap_single_segment(dataset, rand=False)
+
+    assert turn_adjust is None
+    assert abs(frev - expected) / period < 1e-3
+    assert abs(frev / period - repeat) < 1e-2
+
+    # Stopping early gives the result of the original with fewer iterations
+    expected = reference_optimise(htf, dataset, iterations=3)
+    frev, _ = htf._optimise_overlap_single_segment(dataset, rand=False, tol=0.05)
+
+    assert abs(frev - expected) / period < 1e-3
+    assert abs(frev / period - repeat) < 1e-1
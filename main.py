@@ -9,13 +9,40 @@ import os
 import numpy as np
 import pandas as pd
 import sys
+import threading
 from datetime import datetime
 
 import run_ht_analysis
 
+class AnalysisWorker(QThread):
+    # Runs the analysis outside of the GUI thread and reports the progress of each file
+    progress = pyqtSignal(str, dict)
+    finished_analysis = pyqtSignal(object, str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, *args, **kwargs):
+        super(AnalysisWorker, self).__init__()
+        self.args = args
+        self.kwargs = kwargs
+        self.cancel = threading.Event()
+
+    def run(self):
+        try:
+            results, message = run_ht_analysis.ht_analysis(*self.args, progress=self.progress.emit, cancel=self.cancel, **self.kwargs)
+            self.finished_analysis.emit(results, message)
+        except Exception as e:
+            self.failed.emit(str(e))
+
 class MainWindow(QtWidgets.QMainWindow):
+    # Cancel a running analysis and wait for the files which are running, and the pool of
+    # worker processes, to finish before closing
     def closeEvent(self, event):
-        sys.exit()
+        if self.worker is not None:
+            self.worker.cancel.set()
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            self.worker.wait()
+            QApplication.restoreOverrideCursor()
+        event.accept()
 
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -55,6 +82,12 @@ class MainWindow(QtWidgets.QMainWindow):
         self.run_button.clicked.connect(self.on_button_clicked)
         self.run_button.setText("\U00002192 Run")
 
+        # Cancel button, stops the analysis of the remaining files
+        self.cancel_button.clicked.connect(self.cancel_run)
+        self.cancel_button.setText("\U000025A0 Cancel")
+        self.cancel_button.setEnabled(False)
+        self.worker = None
+
         # Choose h5 files by clicking from file list
         self.HT_list_of_files.itemClicked.connect(self.item_clicked)
 
@@ -82,6 +115,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.output_path.setPlainText(output_path)
         self.path_twiss.setPlainText(default_twiss_path)
 
+        # Number of files analysed in parallel
+        self.processes.setMaximum(os.cpu_count())
+        self.processes.setValue(os.cpu_count())
+
         # Menu options
         self.actionScreenshot.triggered.connect(self.take_screenshot)
         #self.actionQuit.triggered.connect(self.closeEvent)
@@ -189,13 +226,24 @@ class MainWindow(QtWidgets.QMainWindow):
     def on_button_clicked(self):
         self.run_button.setStyleSheet("background-color: red;")
         self.run_button.setText("Running...")
-        QApplication.processEvents()
-        loop = QEventLoop()
-        loop.processEvents()
-        self.click_run()
+        self.run_button.setEnabled(False)
+        if not self.click_run():
+            self.run_finished()
+
+    # Restore the buttons once the analysis is over
+    def run_finished(self):
         self.run_button.setStyleSheet("background-color: lightblue;")
         self.run_button.setText("Run")
-        loop.exit()
+        self.run_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.worker = None
+
+    # Stop the analysis after the files which are currently running
+    def cancel_run(self):
+        if self.worker is not None:
+            self.worker.cancel.set()
+            self.cancel_button.setEnabled(False)
+            self.run_button.setText("Cancelling...")
 
     # Main function to run analysis
     def click_run(self):
@@ -215,6 +263,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.final_energy_gev = float(self.energy_gev.text())
         self.final_save_folder = self.output_path.toPlainText()
         self.final_HT_path = self.textEdit_HT_path.toPlainText()
+        self.final_processes = self.processes.value()
 
         try:
             filenames = []
@@ -229,6 +278,7 @@ class MainWindow(QtWidgets.QMainWindow):
                 e = "No h5 files specified!"
                 print("An error occurred:", e)
                 self.create_message_popup(e)
+                return False
 
             self.final_filename_dict.deg=self.final_filename_dict.deg.astype(float)
             self.final_filename_dict.sort_values(by='deg', inplace=True)
@@ -242,29 +292,43 @@ class MainWindow(QtWidgets.QMainWindow):
 
             self.analysis_text.setPlainText(self.message)
        
-            self.final_filename_dict_copy = self.final_filename_dict.copy()
-
             if self.overwrite_files==False:
-                temp_files = []
-                temp_phase = []
-                self.message += "\n\nResult files will not be overwritten\n"
-                for counter, file in enumerate(self.final_filename_dict["filename"]):
-                    myfile = f"{self.final_save_folder}/results_{file}.parquet"
-                    if not os.path.exists(myfile):
-                        temp_files.append(file)
-                        temp_phase.append(self.final_filename_dict["deg"][counter])
-                    else:
-                        self.message += f"Results from {file} already exist in output path, will not repeat the analysis.\n"
-                self.final_filename_dict = {"filename": temp_files, "deg": temp_phase}
+                self.message += "\n\nCached results are reused for files already analysed with the same parameters\n"
                 self.analysis_text.setPlainText(self.message)
-                
-            results, analysis_message = run_ht_analysis.ht_analysis(self.final_HT_path, self.final_energy_gev, self.final_filename_dict, self.final_beta_HT, self.final_qy, self.final_beta_CC, self.final_dmu, self.final_ht_calibration_factor, self.final_save_folder)
-            
-            appended_data = []
-            for file in self.final_filename_dict_copy["filename"]:
-                appended_data.append(pd.read_parquet(f"{self.final_save_folder}/results_{file}.parquet"))
-            results = pd.concat(appended_data)
-            results.rename(columns={'voltage': 'myVcc at t zero[MV]', 'phase': 'deg'}, inplace=True)
+
+            self.message_header = self.message
+            self.scan_points = {}
+            self.graphWidget.clear()
+            self.scan_plot = self.graphWidget.plot([], [], symbol='s', symbolSize = 10)
+
+            self.worker = AnalysisWorker(self.final_HT_path, self.final_energy_gev, self.final_filename_dict, self.final_beta_HT, self.final_qy, self.final_beta_CC, self.final_dmu, self.final_ht_calibration_factor, self.final_save_folder, processes=self.final_processes, render="background", use_cache=not self.overwrite_files)
+            self.worker.progress.connect(self.analysis_progress)
+            self.worker.finished_analysis.connect(self.analysis_finished)
+            self.worker.failed.connect(self.analysis_failed)
+            self.worker.start()
+            self.cancel_button.setEnabled(True)
+            return True
+
+        except Exception as e:
+            print("An error occurred:", e)
+            self.create_message_popup(e)
+            return False
+
+    # Progress of a single file: show the messages and add the point to the plot
+    def analysis_progress(self, event, res):
+        if event == "started":
+            self.message += f"\nStarted {res['filename']} ({res['deg']} deg)\n"
+        else:
+            self.message += res["message"]
+            if event == "ok":
+                self.scan_points[res["index"]] = (float(res["deg"]), res["voltage"])
+                deg, voltage = zip(*sorted(self.scan_points.values()))
+                self.scan_plot.setData(deg, voltage)
+        self.analysis_text.setPlainText(self.message)
+
+    def analysis_finished(self, results, analysis_message):
+        try:
+            results.rename(columns={'Time': 'time'}, inplace=True)
             results.to_parquet(f"{self.final_save_folder}/results.parquet")
             results["deg"] = results.deg.astype(float)
             results.sort_values(by="deg", inplace=True)
@@ -274,18 +338,25 @@ class MainWindow(QtWidgets.QMainWindow):
             self.graphWidget.plot(results.deg, results["myVcc at t zero[MV]"], symbol='s', symbolSize = 10)
 
             now = datetime.now()
-            self.message+=analysis_message
+            self.message = self.message_header + analysis_message
             self.message += f"\n\nApplication finished at {now}\n\n"
             self.analysis_text.setPlainText(self.message)
 
             self.final_results = results
-            
+
             self.fitButton.setEnabled(True)
 
         except Exception as e:
             print("An error occurred:", e)
             self.create_message_popup(e)
 
+        self.run_finished()
+
+    def analysis_failed(self, e):
+        print("An error occurred:", e)
+        self.create_message_popup(e)
+        self.run_finished()
+
 
 def main():
     app = QtWidgets.QApplication([])
@@ -1,7 +1,13 @@
+import concurrent.futures
 import glob
+import hashlib
 import numpy as np
 import pandas as pd
 import imp
+import multiprocessing
+import os
+import pathlib
+import queue
 import time
 import sys
 from matplotlib import cm
@@ -29,25 +35,14 @@ def prep_file(name):
     return htf
 
 def calc_means(htf, N):
-    pts = int(htf.horizontal.sigma.samples_per_bunch)
     M = int(htf.horizontal.sigma.number_of_turns/N)
-    means_delta = []
-    means_sigma = []
-    for i in range(N):
-        mean_delta = np.zeros(pts)
-        mean_sigma = np.zeros(pts)
-        for j in range(M):
-            x, y = htf.vertical.sigma[i*M+j,0]
-            #if j==0:
-            #    print(x,y, "heree6")
-            mean_sigma += y
-            x, y = htf.vertical.delta[i*M+j,0]
-            mean_delta += y
-        mean_delta /= M
-        mean_sigma /= M
-        means_delta.append(mean_delta)
-        means_sigma.append(mean_sigma)
-    return (np.array(means_sigma), np.array(means_delta), x)
+    turns = np.arange(N*M)
+    # Read all turns of the first bunch at once and average each part
+    x, sigma = htf.vertical.sigma.get_turns(turns, 0, 0)
+    x, delta = htf.vertical.delta.get_turns(turns, 0, 0)
+    means_sigma = sigma.reshape(N, M, -1).mean(axis=1, dtype=np.float64)
+    means_delta = delta.reshape(N, M, -1).mean(axis=1, dtype=np.float64)
+    return (means_sigma, means_delta, x)
 
 
 def getOrbitResponse(beta_ht, total_Q, beta_cc, dmuy):
@@ -88,146 +83,358 @@ def mirrored2(maxval, num):
     return np.linspace(-maxval, maxval, num)
 
 ht         = bqht.BQHT(system='SPS')
-def ht_analysis(HT_dataDir, EGeV, interesting_files, my_beta_ht, my_total_Q, my_beta_cc, my_dmuy, ht_calibration_factor, save_folder):
-    
+
+def init_worker():
+    # Every worker of the process pool creates its own BQHT instance and
+    # renders with a non-interactive backend
+    global ht
+    ht = bqht.BQHT(system='SPS')
+    plt.switch_backend('Agg')
+
+def analyse_file(args):
+    # Run the analysis of a single file, errors are collected instead of aborting the scan
+    try:
+        return _analyse_file(*args)
+    except Exception as e:
+        return error_result(args, e)
+
+def error_result(args, e):
+    # Result of a file whose analysis failed
+    i, name, deg = args[:3]
+    print(f'Error in file {name}: {e}')
+    return {"index": i, "filename": name.split("/")[-1], "deg": deg, "status": "error", "message": f"{deg}\nError in file {name}: {e}\n"}
+
+def _analyse_file(i, name, deg, EGeV, my_beta_ht, my_total_Q, my_beta_cc, my_dmuy, ht_calibration_factor, save_folder, render, use_cache):
+    current_filename = name.split("/")[-1]
+    res = {"index": i, "filename": current_filename, "deg": deg, "status": "ok"}
+    message = str(deg)
+    message+="\n"
+    save_png_crab = f"{save_folder}/crab_{current_filename}.png"
+    save_npz_crab = f"{save_folder}/crab_{current_filename}.npz"
+    save_parquet_crab = f"{save_folder}/results_{current_filename}.parquet"
+    cache_folder = f"{save_folder}/.cache"
+
+    print(f'Chosen file for study: {name}')
+    message += f'Chosen file for study: {name}'
+    message+="\n"
+
+    # Compute timestamp from file name
+    time_stamp_temp = name[-9:-3]
+    time_stamp = ':'.join(time_stamp_temp[i:i+2] for i in range(0, len(time_stamp_temp), 2))
+
+    # The turn-averaged signals only depend on the file, the voltage also on the optics.
+    # The means are computed by prep_file and calc_means in this file, so both digests count
+    N = 2
+    means_key = cache_key('means', MEANS_CODE, RESULT_CODE, file_identity(name), N, ht.system, ht.frev, ht.offset, ht.harmonic)
+    result_key = cache_key('result', RESULT_CODE, means_key, EGeV, my_beta_ht, my_total_Q, my_beta_cc, my_dmuy, ht_calibration_factor)
+
+    result = cache_load(cache_folder, result_key) if use_cache else None
+    if result is None:
+        means = cache_load(cache_folder, means_key) if use_cache else None
+        if means is None:
+            means = get_means(name, N)
+            cache_save(cache_folder, means_key, means)
+        result = get_voltage(means, EGeV, my_beta_ht, my_total_Q, my_beta_cc, my_dmuy, ht_calibration_factor)
+        cache_save(cache_folder, result_key, result)
+    else:
+        message += "Using cached results\n"
+
+    message += str(result["message"])
+    if result["status"] == "skipped":
+        print(f'{i} skipped')
+        res.update(status="skipped", message=message)
+        return res
+
+    my_Vcc = float(result["voltage"])
+    res["orbit"] = float(result["orbit"])
+
+    # Keep everything needed to render the figure later without re-reading the file
+    figure = {k: result[k] for k in ('zvals', 'yvals', 'crabwave', 'sigma', 'coeff', 'scale', 'acq_stamp')}
+    # The figure only needs to be rendered again if the analysis or the phase changed,
+    # figure is None if it is up to date, otherwise the files to render it in the background
+    current = cache_load(save_folder, f"crab_{current_filename}")
+    stale = None
+    if current is None or current.get("key") != result_key or current.get("deg") != str(deg) or not os.path.exists(save_png_crab):
+        np.savez(save_npz_crab, deg=str(deg), key=result_key, **figure)
+        if render == 'inline':
+            plot_crab(save_npz_crab, save_png_crab)
+        else:
+            stale = (save_npz_crab, save_png_crab)
+    pd.DataFrame({"time":[time_stamp], "voltage":[my_Vcc], "phase": [deg]}).to_parquet(save_parquet_crab)
+    res.update(time=time_stamp, voltage=my_Vcc, message=message, figure=stale)
+    return res
+
+def get_means(name, N):
+    # Turn-averaged sigma and delta signals of a file, see calc_means
+    htf_0 = prep_file(name)
+    sigma_0, delta_0, time = calc_means(htf_0, N) # time: time within the bunch [s]
+    means = {"sigma": sigma_0, "delta": delta_0, "time": time, "acq_stamp": htf_0.acq_stamp, "frev": htf_0.frev}
+    htf_0.close()
+    return means
+
+def get_voltage(means, EGeV, my_beta_ht, my_total_Q, my_beta_cc, my_dmuy, ht_calibration_factor):
+    # Crab voltage at z=t=0 from the turn-averaged signals of a file
     Eb         = EGeV*1e9
-    
-    import pathlib
+
+    # Remove baseline from delta signals: split acquisitions in 2 parts, before and after RF synchronization to subtract baseline in delta signal, see Natalia's thesis
+    sigma_0, delta_0, time = means["sigma"], means["delta"], means["time"]
+    message = f"frev = {means['frev']}\n"
+    # Acquisitions filtering: if the signal is low, max of sigma_0 will be very small
+    if np.sum(sigma_0/np.amax(sigma_0)) > 300: #another filtering for not good files
+        return {"status": "skipped", "message": message + "skipped\n"}
+
+    # Convert from arbitrary units to mm
+    x_r = 15
+    x_l = 16
+    crabwave, sigma = getHTtraces(sigma_0,  delta_0, x_r, x_l, ht_calibration_factor)
+    #print(len(crabwave), "crabwave")
+
+    # The crabbing signal is around the maximum of the sigma signal, focus around this longitudinal regime as we are interested in t=z=0
+    max_v = np.argmax(sigma_0[-1])
+    x_min  = max_v - x_r
+    x_max  = max_v + x_l
+    maxval = time[x_min:x_max][-1]- time[x_min:x_max][0]
+    num    = len(time[x_min:x_max])
+    long_position = mirrored2(maxval/2, num)
+    #print(np.diff(long_position*1e9))
+    x = np.arange(long_position[0]*1e9, long_position[-1]*1e9, 0.1)
+    #x = np.arange(long_position[0]*1e9, long_position[-1]*1e9, np.diff(long_position*1e9)[0])
+    #print(len(x), " x", np.diff(long_position*1e9)[0])
+
+    # Orbit signal interpolated
+    crabInterp = interp1d(x, crabwave, bounds_error=False, fill_value=0)
+
+    # To compute kick from orbit, calculates the other factors (cosine and sine) in formula
+    orbitResponse = getOrbitResponse(my_beta_ht, my_total_Q, my_beta_cc, my_dmuy)
+
+    # Fit sigma signal
+    p0 = [2000., 0., 0.18]
+    coeff, var_matrix = curve_fit(gauss, x, sigma, p0=p0)
+
+    yvals = np.arange(-6,6,np.diff(long_position*1e9)[0])
+    zvals = x
+
+    # Find index closer to t=z=0
+    value_closer_to_zero, index_for_z_0 = find_nearest(zvals, 0)
+    print(f'zvals for index {index_for_z_0} = {zvals[index_for_z_0]}')
+    message += f'zvals for index {index_for_z_0} = {zvals[index_for_z_0]}'
+    message+="\n"
+
+    # Voltage from orbit: Vcc = - kick* Eb/q, kick = orbit_meas/orbit_response
+
+    message +=f"crab[z0]={crabInterp(zvals)[index_for_z_0]}"
+    message+="\n"
+
+    Vcc_interp =  -crabInterp(zvals)*Eb/(orbitResponse*1e9)
+    my_Vcc     = Vcc_interp[index_for_z_0] # Vcc at z=t=0
+    print(f'Vcc for z=t=0 = {my_Vcc} MV')
+    message +=f"Vcc for z=t=0 = {my_Vcc} MV"
+    message+="\n"
+    print("")
+
+    return {"status": "ok", "message": message, "voltage": my_Vcc, "orbit": crabInterp(zvals)[index_for_z_0],
+            "zvals": zvals, "yvals": yvals, "crabwave": crabwave, "sigma": sigma, "coeff": coeff,
+            "scale": Eb/(orbitResponse*1e9), "acq_stamp": means["acq_stamp"]}
+
+# Bump when the cached means or results change. The keys also include a digest of the code
+# computing them, so that results of an older analysis are never reused by mistake
+CACHE_VERSION = 2
+
+def code_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+MEANS_CODE = code_digest(bqht.__file__)
+RESULT_CODE = code_digest(__file__)
+
+def file_identity(name):
+    # A data file is identified by its name, size, modification time and a hash of its first MB
+    st = os.stat(name)
+    with open(name, 'rb') as f:
+        head = hashlib.sha1(f.read(2**20)).hexdigest()
+    return (name.split("/")[-1], st.st_size, st.st_mtime_ns, head)
+
+def cache_key(*args):
+    return hashlib.sha1(repr((CACHE_VERSION,) + args).encode()).hexdigest()
+
+def cache_load(cache_folder, key):
+    # Returns the cached arrays for key, or None if there are none
+    try:
+        with np.load(f"{cache_folder}/{key}.npz") as data:
+            return {k: data[k] for k in data.files}
+    except (OSError, ValueError):
+        return None
+
+def cache_save(cache_folder, key, data):
+    # Write to a temporary file first so that concurrent workers never read a partial file
+    pathlib.Path(cache_folder).mkdir(parents=True, exist_ok=True)
+    tmp = f"{cache_folder}/{key}.{os.getpid()}.tmp.npz"
+    np.savez(tmp, **data)
+    os.replace(tmp, f"{cache_folder}/{key}.npz")
+
+def plot_crab(data_file, save_png_crab):
+    # Render the crabbing figure of a file from the arrays saved by the analysis
+    with np.load(data_file) as f:
+        data = {k: f[k] for k in f.files}
+    zvals, yvals, crabwave, sigma, coeff, scale = (data[k] for k in ('zvals', 'yvals', 'crabwave', 'sigma', 'coeff', 'scale'))
+    crabInterp = interp1d(zvals, crabwave, bounds_error=False, fill_value=0)
+
+    # Compute colorbar
+    yy,zz = np.meshgrid(yvals,zvals)
+    aa = varFunc(yy-crabInterp(zz),zz, coeff)#/(np.trapz(gauss(zvals, coeff[0], coeff[1], coeff[2]),x=zvals))
+
+    # Plotting part
+    fig = plt.figure(figsize=(8,8))
+    gs  = grd.GridSpec(2, 2, height_ratios=[10,10], width_ratios=[8,1], wspace=0.1)
+    ax1 = plt.subplot(gs[2])
+    cax = ax1.pcolormesh(zz, yy, aa/np.amax(aa), cmap = cm.jet)
+
+    colorax = plt.subplot(gs[3])
+    cbar = plt.colorbar(cax, cax=colorax)
+    cbar.set_label('Norm. Intensity', fontsize=16)
+    colorax.tick_params(axis='both', labelsize=18)
+    ax2 = plt.subplot(gs[0])
+    ax2.plot(zvals, -crabwave*scale, color='r')
+    ax2.plot(zvals, -crabInterp(zvals)*scale, color='g', ls='--')
+
+
+    ax2.axes.get_xaxis().set_visible(False)
+    ax22 = ax2.twinx()
+    ax22.plot(zvals, sigma/np.amax(sigma), color='k', linestyle='dashed', label='Sum Signal')
+    ax22.set_ylabel('Sum Signal [A.U.]', fontsize=16)
+    ax22.tick_params(axis='both', which='both', labelsize=18)
+    ax22.plot([0],[0.1],color='r', label=r'$V_{CC}$')
+    ax22.legend(loc=1, frameon=False, fontsize=12)
+    #ax22.set_ylim([0,1])
+
+    ax2.set_ylim(-2.4,2.1)
+    ax1.set_xlabel('t [ns]', fontsize=18)
+    ax1.set_ylabel('y [mm]', fontsize=18)
+    ax2.set_ylabel(r'$V_{CC}\ \mathrm{[MV]}$', fontsize=18)
+    ax1.tick_params(axis='both', which='both', labelsize=18)
+    ax2.tick_params(axis='both', which='both', labelsize=18)
+    fig.subplots_adjust(left=0.16, hspace=0.05, top=0.905)
+    plt.suptitle('Crabbing Voltage from Head-Tail Monitor \n' + unix2string(data["acq_stamp"]/1e9)[:-7] + f' Phase {data["deg"]} deg', fontsize=18)
+    #plt.savefig(f'figures/' + unix2string(data["acq_stamp"]/1e9)[11:-7].replace(':','')+'.png')
+    #plt.show()
+    fig.savefig(save_png_crab)
+    plt.close(fig)
+
+def render_background(figures, processes=1, progress=None):
+    # Render figures in a pool of Agg worker processes and wait for them. Figures which could
+    # not be rendered are reported with progress('render_error', res) and in the returned message
+    message = ""
+    with worker_pool(processes) as pool:
+        futures = {pool.submit(plot_crab, *figure): figure for figure in figures}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                png = futures[future][1]
+                print(f'Error rendering {png}: {e}')
+                res = {"filename": png.split("/")[-1], "status": "error", "message": f"\nError rendering {png}: {e}\n"}
+                message += res["message"]
+                if progress is not None:
+                    progress("render_error", res)
+    return message
+
+def worker_pool(processes):
+    # Pool of worker processes, they are started with spawn as the pool is created from the
+    # analysis thread of a running Qt application, which is not safe to fork
+    return concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=init_worker)
+
+def _submit(pool, task, done):
+    # Analyse a file in the pool and put its result on done. A worker which dies (e.g. killed
+    # when out of memory) or a result which cannot be sent back gives an error result, so that
+    # the result of every file submitted is always put on done. Once a worker died the pool
+    # does not accept more files, they fail in the same way
+    def finished(future):
+        try:
+            done.put(future.result())
+        except Exception as e:
+            done.put(error_result(task, e))
+    try:
+        pool.submit(analyse_file, task).add_done_callback(finished)
+    except Exception as e:
+        done.put(error_result(task, e))
+
+def _run_tasks(tasks, processes, submit, progress, cancel):
+    # Keep at most processes files in flight so that cancelling stops the remaining files
+    # while the running ones finish cleanly
+    done = queue.Queue()
+    results = []
+
+    def collect():
+        res = done.get()
+        results.append(res)
+        if progress is not None:
+            progress(res["status"], res)
+
+    submitted = 0
+    for task in tasks:
+        while submitted - len(results) >= processes:
+            collect()
+        if cancel is not None and cancel.is_set():
+            break
+        if progress is not None:
+            progress("started", {"index": task[0], "filename": task[1].split("/")[-1], "deg": task[2]})
+        submit(task, done)
+        submitted += 1
+    while submitted > len(results):
+        collect()
+    return results
+
+def ht_analysis(HT_dataDir, EGeV, interesting_files, my_beta_ht, my_total_Q, my_beta_cc, my_dmuy, ht_calibration_factor, save_folder, processes=1, render='inline', use_cache=True, progress=None, cancel=None):
+    # processes > 1 analyses the files in parallel in a pool of worker processes
+    # render: 'inline' to render the figures during the analysis, 'background' to render
+    # them afterwards in a pool of worker processes, waiting for them, or None to only save
+    # the data (see plot_crab)
+    # use_cache: reuse the results cached in save_folder for unchanged files and parameters,
+    # otherwise everything is recomputed and the cache refreshed
+    # progress(event, res) is called with event 'started' when the analysis of a file starts and
+    # with the status of the result ('ok', 'skipped' or 'error') when it finishes
+    # cancel: a threading.Event, once set no more files are started
+
     pathlib.Path(save_folder).mkdir(parents=True, exist_ok=True)
 
     files_list = [f"{HT_dataDir}/{i}" for i in interesting_files["filename"]]
 
-    time_stamp_list   = []
-    deg_list          = []
-    my_Vcc_list       = []
-    ignore_files_list = [] 
-    
-    skipped           = []
-    res_orbit = []
-    message = "\n\nRunning HT analysis\n\n"    
+    ignore_files_list = []
+
+    tasks = []
     for i, name in enumerate(files_list[:]):
-        message += str(interesting_files["deg"][i]) 
-        message+="\n"
-        current_filename = interesting_files["filename"][i]
-        save_png_crab = f"{save_folder}/crab_{current_filename}.png"
-        save_parquet_crab = f"{save_folder}/results_{current_filename}.parquet"
-    
         if name.split("/")[-1] in ignore_files_list:
             print(f'file {name.split("/")[-1]} ignored')
             continue
-    
-        print(f'Chosen file for study: {name}')
-        message += f'Chosen file for study: {name}' 
-        message+="\n"
-    
-        # Compute timestamp from file name
-        time_stamp_temp = name[-9:-3]
-        time_stamp = ':'.join(time_stamp_temp[i:i+2] for i in range(0, len(time_stamp_temp), 2))
-    
-        htf_0 = prep_file(name)
-    
-        # Remove baseline from delta signals: split acquisitions in 2 parts, before and after RF synchronization to subtract baseline in delta signal, see Natalia's thesis
-        N = 2
-        sigma_0, delta_0, time = calc_means(htf_0, N) # time: time within the bunch [s]
-        # Acquisitions filtering: if the signal is low, max of sigma_0 will be very small
-        if np.sum(sigma_0/np.amax(sigma_0)) > 300: #another filtering for not good files
-            print(f'{i} skipped')
-            skipped.append(i)
-            continue
-    
-        # Convert from arbitrary units to mm
-        x_r = 15
-        x_l = 16
-        crabwave, sigma = getHTtraces(sigma_0,  delta_0, x_r, x_l, ht_calibration_factor)
-        #print(len(crabwave), "crabwave")
-    
-        # The crabbing signal is around the maximum of the sigma signal, focus around this longitudinal regime as we are interested in t=z=0
-        max_v = np.argmax(sigma_0[-1])
-        x_min  = max_v - x_r
-        x_max  = max_v + x_l
-        maxval = time[x_min:x_max][-1]- time[x_min:x_max][0]
-        num    = len(time[x_min:x_max])
-        long_position = mirrored2(maxval/2, num)
-        #print(np.diff(long_position*1e9))
-        x = np.arange(long_position[0]*1e9, long_position[-1]*1e9, 0.1)
-        #x = np.arange(long_position[0]*1e9, long_position[-1]*1e9, np.diff(long_position*1e9)[0])
-        #print(len(x), " x", np.diff(long_position*1e9)[0])
-    
-        # Orbit signal interpolated
-        crabInterp = interp1d(x, crabwave, bounds_error=False, fill_value=0)
-    
-        # To compute kick from orbit, calculates the other factors (cosine and sine) in formula
-        orbitResponse = getOrbitResponse(my_beta_ht, my_total_Q, my_beta_cc, my_dmuy)
- 
-        # Fit sigma signal
-        p0 = [2000., 0., 0.18]
-        coeff, var_matrix = curve_fit(gauss, x, sigma, p0=p0)
-    
-        # Compute colorbar
-        yvals = np.arange(-6,6,np.diff(long_position*1e9)[0])
-        zvals = x
-        yy,zz = np.meshgrid(yvals,zvals)
-        aa = varFunc(yy-crabInterp(zz),zz, coeff)#/(np.trapz(gauss(zvals, coeff[0], coeff[1], coeff[2]),x=zvals))
-    
-        # Find index closer to t=z=0
-        value_closer_to_zero, index_for_z_0 = find_nearest(zvals, 0)
-        print(f'zvals for index {index_for_z_0} = {zvals[index_for_z_0]}')
-        message += f'zvals for index {index_for_z_0} = {zvals[index_for_z_0]}' 
-        message+="\n"
-    
-        # Voltage from orbit: Vcc = - kick* Eb/q, kick = orbit_meas/orbit_response
-    
-        message +=f"crab[z0]={crabInterp(zvals)[index_for_z_0]}"
-        message+="\n"
-        res_orbit.append(crabInterp(zvals)[index_for_z_0])
-    
-        Vcc_interp =  -crabInterp(zvals)*Eb/(orbitResponse*1e9)
-        my_Vcc     = Vcc_interp[index_for_z_0] # Vcc at z=t=0
-        my_Vcc_list.append(my_Vcc)
-        print(f'Vcc for z=t=0 = {my_Vcc} MV')
-        message +=f"Vcc for z=t=0 = {my_Vcc} MV"
-        message+="\n"
-        print("")
-    
-        # Plotting part
-        fig = plt.figure(figsize=(8,8))
-        gs  = grd.GridSpec(2, 2, height_ratios=[10,10], width_ratios=[8,1], wspace=0.1)
-        ax1 = plt.subplot(gs[2])
-        cax = ax1.pcolormesh(zz, yy, aa/np.amax(aa), cmap = cm.jet)
-    
-        colorax = plt.subplot(gs[3])
-        cbar = plt.colorbar(cax, cax=colorax)
-        cbar.set_label('Norm. Intensity', fontsize=16)
-        colorax.tick_params(axis='both', labelsize=18)
-        ax2 = plt.subplot(gs[0])
-        ax2.plot(zvals, -crabwave*Eb/(orbitResponse*1e9), color='r')
-        ax2.plot(zvals, -crabInterp(zvals)*Eb/(orbitResponse*1e9), color='g', ls='--')
-    
-    
-        ax2.axes.get_xaxis().set_visible(False)
-        ax22 = ax2.twinx()
-        ax22.plot(x, sigma/np.amax(sigma), color='k', linestyle='dashed', label='Sum Signal')
-        ax22.set_ylabel('Sum Signal [A.U.]', fontsize=16)
-        ax22.tick_params(axis='both', which='both', labelsize=18)
-        ax22.plot([0],[0.1],color='r', label=r'$V_{CC}$')
-        ax22.legend(loc=1, frameon=False, fontsize=12)
-        #ax22.set_ylim([0,1])
-    
-        ax2.set_ylim(-2.4,2.1)
-        ax1.set_xlabel('t [ns]', fontsize=18)
-        ax1.set_ylabel('y [mm]', fontsize=18)
-        ax2.set_ylabel(r'$V_{CC}\ \mathrm{[MV]}$', fontsize=18)
-        ax1.tick_params(axis='both', which='both', labelsize=18)
-        ax2.tick_params(axis='both', which='both', labelsize=18)
-        fig.subplots_adjust(left=0.16, hspace=0.05, top=0.905)
-        plt.suptitle('Crabbing Voltage from Head-Tail Monitor \n' + unix2string(htf_0.acq_stamp/1e9)[:-7] + f' Phase {interesting_files["deg"][i]} deg', fontsize=18)
-        #plt.savefig(f'figures/' + unix2string(htf_0.acq_stamp/1e9)[11:-7].replace(':','')+'.png')
-        #plt.show()
-        time_stamp_list.append(time_stamp)
-        deg_list.append(interesting_files["deg"][i])
-        fig.savefig(save_png_crab)
-        pd.DataFrame({"time":[time_stamp_list[-1]], "voltage":[my_Vcc_list[-1]], "phase": [deg_list[-1]]}).to_parquet(save_parquet_crab) 
-    df = pd.DataFrame(list(zip(time_stamp_list, my_Vcc_list, deg_list)), columns =['Time', 'myVcc at t zero[MV]', 'deg'])
+        tasks.append((i, name, interesting_files["deg"][i], EGeV, my_beta_ht, my_total_Q, my_beta_cc, my_dmuy, ht_calibration_factor, save_folder, render, use_cache))
+
+    message = "\n\nRunning HT analysis\n\n"
+    processes = min(processes, len(tasks))
+    if processes > 1:
+        with worker_pool(processes) as pool:
+            results = _run_tasks(tasks, processes, lambda task, done: _submit(pool, task, done), progress, cancel)
+    else:
+        results = _run_tasks(tasks, 1, lambda task, done: done.put(analyse_file(task)), progress, cancel)
+    if cancel is not None and cancel.is_set():
+        message += f"Analysis cancelled after {len(results)} of {len(tasks)} file(s)\n\n"
+
+    # Merge the results in phase order
+    results.sort(key=lambda res: (float(res["deg"]), res["index"]))
+    ok = [res for res in results if res["status"] == "ok"]
+    skipped = [res["index"] for res in results if res["status"] == "skipped"]
+    errors = [res["index"] for res in results if res["status"] == "error"]
+
+    for res in results:
+        message += res["message"]
+    if skipped or errors:
+        message += f"\n{len(skipped)} file(s) skipped, {len(errors)} file(s) failed\n"
+
+    stale = [res["figure"] for res in ok if res["figure"] is not None]
+    if render == 'background' and stale:
+        message += render_background(stale, max(processes, 1), progress)
+
+    df = pd.DataFrame([(res["time"], res["voltage"], res["deg"]) for res in ok], columns =['Time', 'myVcc at t zero[MV]', 'deg'])
     df.to_parquet(f"{save_folder}/results.parquet")
     return df, message
 